@@ -0,0 +1,137 @@
+"""Замер холодного старта бота: от запуска процесса до обработки первого апдейта.
+
+    python bench_startup.py                     # 5 запусков, сводка по фазам
+    python bench_startup.py -n 20 --json s.json # отчёт в JSON (для сравнения релизов)
+    python bench_startup.py --budget 1.0        # код возврата 1, если медиана total дольше 1 с
+    python bench_startup.py --app-budget 0.3    # то же для доли бота (total без interpreter и aiogram)
+
+Каждый запуск — отдельный процесс python: импорт aiogram, импорт bot.py, create_app() с заглушкой
+Bot API из replay.py, on_startup и один апдейт /start через dispatcher. Сеть не используется,
+STATE_FILE, RECORD_DIR и HEALTH_PORT в дочернем процессе отключены.
+
+Импорт aiogram вынесен в отдельную фазу: на aiogram 3.4.1 он сам по себе занимает секунды
+(pydantic-модели всех типов Bot API), и бот на это не влияет. --app-budget следит за тем,
+что добавляет сам бот, --budget — за общей целью «старт быстрее секунды».
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from typing import Any, Dict, List, Optional
+
+PHASES = ("interpreter", "aiogram", "import", "create_app", "startup", "first_update")
+
+
+async def child_run() -> Dict[str, Any]:
+    started_at = time.time()
+    t0 = time.perf_counter()
+    marks: Dict[str, float] = {}
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from replay import make_stub_session, prepare_env
+
+    prepare_env({"support_chat_id": -100})
+    os.environ.pop("STATE_FILE", None)
+
+    import aiogram  # noqa: F401
+    marks["aiogram"] = time.perf_counter() - t0
+
+    import bot as bot_module
+    marks["import"] = time.perf_counter() - t0
+
+    session = make_stub_session(0)
+    bot, dp = bot_module.create_app(session)
+    marks["create_app"] = time.perf_counter() - t0
+
+    await dp.emit_startup(bot=bot)
+    marks["startup"] = time.perf_counter() - t0
+
+    from aiogram.types import Update
+    update = Update.model_validate({
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": int(time.time()),
+            "chat": {"id": 1001, "type": "private"},
+            "from": {"id": 1001, "is_bot": False, "first_name": "bench"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }, context={"bot": bot})
+    await dp.feed_update(bot, update)
+    marks["first_update"] = time.perf_counter() - t0
+
+    await dp.emit_shutdown(bot=bot)
+    return {"started_at": started_at, "marks": marks, "api_calls": dict(session.calls)}
+
+
+def run_once() -> Dict[str, float]:
+    spawned_at = time.time()
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child"],
+        capture_output=True, text=True, check=True,
+    )
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    # фазы — приращения от начала процесса
+    phases = {"interpreter": result["started_at"] - spawned_at}
+    prev = 0.0
+    for name in PHASES[1:]:
+        phases[name] = result["marks"][name] - prev
+        prev = result["marks"][name]
+    phases["total"] = phases["interpreter"] + prev
+    phases["app"] = phases["total"] - phases["interpreter"] - phases["aiogram"]
+    return phases
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Замер времени от запуска процесса до первого апдейта.")
+    parser.add_argument("-n", type=int, default=5, help="число запусков")
+    parser.add_argument("--json", help="сохранить отчёт в JSON")
+    parser.add_argument("--budget", type=float, help="допустимая медиана total, с")
+    parser.add_argument("--app-budget", type=float, help="допустимая медиана app (доля бота), с")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        import asyncio
+        print(json.dumps(asyncio.run(child_run())))
+        return
+
+    from replay import percentile
+
+    runs = [run_once() for _ in range(args.n)]
+    report = {
+        "runs": args.n,
+        "python": sys.version.split()[0],
+        "phases": {
+            name: {
+                "p50_ms": round(percentile([r[name] for r in runs], 0.5) * 1000, 1),
+                "p95_ms": round(percentile([r[name] for r in runs], 0.95) * 1000, 1),
+                "max_ms": round(max(r[name] for r in runs) * 1000, 1),
+            }
+            for name in (*PHASES, "total", "app")
+        },
+    }
+
+    print(f"Запусков: {args.n}, python {report['python']}")
+    print(f"\n{'фаза':<16}{'p50':>10}{'p95':>10}{'макс.':>10}  (мс)")
+    for name, p in report["phases"].items():
+        print(f"{name:<16}{p['p50_ms']:>10}{p['p95_ms']:>10}{p['max_ms']:>10}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    over = False
+    for name, budget in (("total", args.budget), ("app", args.app_budget)):
+        p50 = report["phases"][name]["p50_ms"]
+        if budget is not None and p50 > budget * 1000:
+            print(f"\nМедиана {name} {p50} мс больше бюджета {budget * 1000:.0f} мс")
+            over = True
+    if over:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
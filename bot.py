@@ -1,37 +1,252 @@
 import os
+import re
+import sys
+import glob
+import gzip
+import hmac
+import json
+import math
+import queue
+import time
+import base64
+import hashlib
+import inspect
+import signal
+import heapq
+import itertools
+import bisect
 import asyncio
-from dataclasses import dataclass, field
+import logging
+import threading
+from collections import Counter
+from dataclasses import asdict, dataclass, field
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Mapping, Optional, Set, Tuple
 
 from aiogram import Bot, Dispatcher, Router, F
-from aiogram.filters import CommandStart
+from aiogram.client.session.base import BaseSession
+from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import (
     Message,
     CallbackQuery,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     FSInputFile,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    Update,
 )
 
-BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
-SUPPORT_CHAT_ID_RAW = os.getenv("SUPPORT_CHAT_ID", "").strip()
-
-if not BOT_TOKEN:
-    raise RuntimeError("Не задан BOT_TOKEN в переменных окружения.")
-if not SUPPORT_CHAT_ID_RAW:
-    raise RuntimeError("Не задан SUPPORT_CHAT_ID (ID группы) в переменных окружения.")
+logger = logging.getLogger("support_bot")
+
+# -------------------- Маршрутизация по группам --------------------
+# SUPPORT_ROUTES: куда отправлять карточки категории (по умолчанию — SUPPORT_CHAT_ID).
+# Формат: "BUG=-1001,-1002:15;PAYMENT_RU=-1003:7,-1004::ro"
+#   chat_id[:thread_id[:ro]] — thread_id = тема форума (message_thread_id),
+#   ro — карточка без кнопок (только для чтения, например лента руководителя).
+# Первый получатель без ro — основной: туда уходят уведомления и ответы по тикету.
+@dataclass(frozen=True)
+class Destination:
+    chat_id: int
+    thread_id: Optional[int] = None
+    readonly: bool = False
+
+def parse_destination(raw: str) -> Destination:
+    chat, _, rest = raw.partition(":")
+    thread, _, flag = rest.partition(":")
+    if flag not in ("", "ro"):
+        raise ValueError(raw)
+    return Destination(
+        chat_id=int(chat),
+        thread_id=int(thread) if thread else None,
+        readonly=flag == "ro",
+    )
 
-SUPPORT_CHAT_ID = int(SUPPORT_CHAT_ID_RAW)
+def parse_routes(raw: str) -> Dict[str, List[Destination]]:
+    routes: Dict[str, List[Destination]] = {}
+    for part in raw.split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        code, sep, dests = part.partition("=")
+        try:
+            if not sep:
+                raise ValueError(part)
+            parsed = [parse_destination(d) for d in dests.replace(" ", "").split(",") if d]
+        except ValueError:
+            raise RuntimeError(f"Некорректный маршрут в SUPPORT_ROUTES: {part!r}")
+        if not any(not d.readonly for d in parsed):
+            raise RuntimeError(f"В SUPPORT_ROUTES для {code.strip()} нужен хотя бы один получатель без ro.")
+        routes[code.strip()] = parsed
+    return routes
+
+# -------------------- Настройки из окружения --------------------
+# Все переменные окружения читаются при первом обращении (get_settings/create_app), а не при импорте:
+# хэндлеры и хелперы можно импортировать без окружения (тесты, утилиты), а ошибка в значении
+# всплывает при старте с именем переменной. Смысл каждой переменной — в комментарии её раздела.
+# BOT_TOKEN и SUPPORT_CHAT_ID обязательны для запуска — проверяет create_app().
+@dataclass(frozen=True)
+class Settings:
+    bot_token: str
+    support_chat_id: Optional[int]
+    routes: Mapping[str, List[Destination]]
+    routes_spec: str               # SUPPORT_ROUTES как есть (пишется в заголовок записи трафика)
+    default_route: List[Destination]
+    support_chats: FrozenSet[int]  # все группы поддержки: отсюда принимаем кнопки админов и ответы
+    cb_secret: bytes               # ключ подписи callback_data
+    assign_rules: Mapping[str, Set[int]]
+    assign_ack_timeout: int
+    stale_close_after: int
+    receipt_remind_after: int
+    sla_new_after: int
+    state_file: str
+    shutdown_timeout: float
+    health_port: int
+    health_max_lag: float
+    profile_dir: str
+    profile_post_summary: bool
+    dashboard_interval: int
+    record_dir: str
+    record_salt: str
+    record_rotate_mb: int
+    record_keep_files: int
+    followup_batch_delay: float
+    config_path: str
+    config_watch_interval: int
+
+def env_number(name: str, default: str, kind: Callable[[str], Any] = int) -> Any:
+    raw = os.getenv(name, default).strip() or default
+    try:
+        return kind(raw)
+    except ValueError:
+        raise RuntimeError(f"Некорректное значение {name}={raw!r}: нужно {'целое ' if kind is int else ''}число.")
+
+def load_settings() -> Settings:
+    token = os.getenv("BOT_TOKEN", "").strip()
+    chat_id = env_number("SUPPORT_CHAT_ID", "0") or None
+    routes_spec = os.getenv("SUPPORT_ROUTES", "").strip()
+    routes = parse_routes(routes_spec)
+    default_route = [Destination(chat_id)] if chat_id is not None else []
+    return Settings(
+        bot_token=token,
+        support_chat_id=chat_id,
+        routes=MappingProxyType(routes),
+        routes_spec=routes_spec,
+        default_route=default_route,
+        support_chats=frozenset({d.chat_id for d in default_route} | {d.chat_id for ds in routes.values() for d in ds}),
+        cb_secret=hashlib.sha256(f"callback:{token}".encode()).digest(),
+        assign_rules=MappingProxyType(parse_assign_rules(os.getenv("ASSIGN_RULES", ""))),
+        assign_ack_timeout=env_number("ASSIGN_ACK_TIMEOUT", "300"),
+        stale_close_after=env_number("STALE_CLOSE_AFTER", str(72 * 3600)),
+        receipt_remind_after=env_number("RECEIPT_REMIND_AFTER", "3600"),
+        sla_new_after=env_number("SLA_NEW_AFTER", "1800"),
+        state_file=os.getenv("STATE_FILE", "").strip(),
+        shutdown_timeout=env_number("SHUTDOWN_TIMEOUT", "25", float),
+        health_port=env_number("HEALTH_PORT", "0"),
+        health_max_lag=env_number("HEALTH_MAX_LAG", "1.0", float),
+        profile_dir=os.getenv("PROFILE_DIR", "profiles"),
+        profile_post_summary=os.getenv("PROFILE_POST_SUMMARY", "") == "1",
+        dashboard_interval=env_number("DASHBOARD_INTERVAL", "60"),
+        record_dir=os.getenv("RECORD_DIR", "").strip(),
+        record_salt=os.getenv("RECORD_SALT", ""),
+        record_rotate_mb=env_number("RECORD_ROTATE_MB", "20"),
+        record_keep_files=env_number("RECORD_KEEP_FILES", "50"),
+        followup_batch_delay=env_number("FOLLOWUP_BATCH_DELAY", "3", float),
+        config_path=os.getenv("CONFIG_PATH", "config.json"),
+        config_watch_interval=env_number("CONFIG_WATCH_INTERVAL", "10"),
+    )
 
-MAX_ATTACHMENTS = 5
+SETTINGS: Optional[Settings] = None
+
+def get_settings() -> Settings:
+    global SETTINGS
+    if SETTINGS is None:
+        SETTINGS = load_settings()
+    return SETTINGS
+
+def route_for(category: str) -> List[Destination]:
+    settings = get_settings()
+    return settings.routes.get(category) or settings.default_route
+
+def primary_destination(category: str) -> Destination:
+    return next(d for d in route_for(category) if not d.readonly)
+
+# -------------------- Назначение админов --------------------
+# ASSIGN_RULES: какие админы могут получать тикеты категории.
+# Формат: "PAYMENT_RU=111,222;PAYMENT=111" (категории без правила — любой админ онлайн).
+# ASSIGN_ACK_TIMEOUT: сколько секунд ждём «🟡 В работе»/ответа, прежде чем переназначить.
+def parse_id_list(raw: str) -> List[int]:
+    return [int(x) for x in raw.replace(" ", "").split(",") if x]
+
+def parse_assign_rules(raw: str) -> Dict[str, Set[int]]:
+    rules: Dict[str, Set[int]] = {}
+    for part in raw.split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        code, sep, ids = part.partition("=")
+        try:
+            if not sep:
+                raise ValueError(part)
+            rules[code.strip()] = set(parse_id_list(ids))
+        except ValueError:
+            raise RuntimeError(f"Некорректное правило в ASSIGN_RULES: {part!r}")
+    return rules
+
+
+# -------------------- Таймеры и сохранение состояния --------------------
+# Сроки в секундах, 0 — выключено.
+# STALE_CLOSE_AFTER: тикет «В работе» без новых сообщений закрывается автоматически.
+# RECEIPT_REMIND_AFTER: напомнить про чек, если после QR пользователь так его и не прислал.
+# SLA_NEW_AFTER: напоминать в группе (повторно с тем же интервалом), пока тикет «Новое».
+# STATE_FILE: JSON-снимок открытых тикетов и таймеров (переживает перезапуск); пусто — только в памяти.
+#   Закрытые тикеты дописываются в STATE_FILE.closed.jsonl (по строке на закрытие), снимок их не содержит.
+STATE_SAVE_INTERVAL = 30
+
+# -------------------- Остановка и health-check --------------------
+# SHUTDOWN_TIMEOUT: сколько секунд после SIGTERM ждём незавершённые обработчики.
+# HEALTH_PORT: порт для /healthz и /readyz (0 — HTTP не поднимаем).
+# HEALTH_MAX_LAG: задержка event loop (сек), после которой /healthz отвечает 503.
+LOOP_LAG_INTERVAL = 0.5
+
+# -------------------- Профилирование --------------------
+# /profile [сек] в группе поддержки (только админы чата) или SIGUSR2 на процесс.
+# PROFILE_DIR: куда писать .collapsed (flamegraph.pl / speedscope) и сводку .txt.
+# PROFILE_POST_SUMMARY=1: сводку сессии по сигналу отправлять в SUPPORT_CHAT_ID.
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 300
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# -------------------- Дашборд --------------------
+# DASHBOARD_INTERVAL: как часто (сек) обновлять закреплённую сводку в SUPPORT_CHAT_ID; 0 — выключено.
+
+# -------------------- Запись трафика --------------------
+# RECORD_DIR: включает запись входящих апдейтов в ротируемые .jsonl.gz (для replay.py).
+# ID пользователей, имена, тексты и file_id хэшируются (соль RECORD_SALT, по умолчанию от BOT_TOKEN).
+
+# -------------------- Дополнения к обращению --------------------
+# Сообщения пользователя вне сценария дописываются к его последнему открытому обращению
+# (реплаем под карточкой). Всё, что пришло за FOLLOWUP_BATCH_DELAY сек после первого
+# сообщения, уходит в группу одним постом.
+
+# -------------------- Категории, тарифы, вложения (config.json) --------------------
+# CONFIG_PATH: JSON с категориями, тарифами оплаты РФ (с QR-файлами) и лимитом вложений.
+# Файл проверяется и собирается в неизменяемый Catalog (таблицы + готовые клавиатуры),
+# который подменяется целиком — при изменении файла (проверка раз в CONFIG_WATCH_INTERVAL сек,
+# 0 — не следить) или по команде /reload. Без файла используются значения ниже.
+
+DEFAULT_MAX_ATTACHMENTS = 5
 
-# -------------------- Категории --------------------
 # Добавлено: PAYMENT_RU (Оплата РФ по QR)
-CATEGORIES: List[Tuple[str, str]] = [
+DEFAULT_CATEGORIES: List[Tuple[str, str]] = [
     ("BUG", "🐞 Ошибка"),
     ("QUESTION", "❓ Вопрос"),
     ("IDEA", "💡 Предложение"),
@@ -40,7 +255,6 @@ CATEGORIES: List[Tuple[str, str]] = [
     ("AUTH", "🔐 Вход / аккаунт"),
     ("OTHER", "🧩 Другое"),
 ]
-CAT_TITLE = {code: title for code, title in CATEGORIES}
 
 # -------------------- Статусы --------------------
 STATUS_LABEL = {
@@ -51,22 +265,15 @@ STATUS_LABEL = {
 
 # -------------------- Оплата РФ (QR) --------------------
 # ВАЖНО:
-# 1) Положите QR-картинки в репозиторий рядом с bot.py (или поменяйте пути ниже).
+# 1) Положите QR-картинки в репозиторий рядом с bot.py (или поменяйте пути в config.json).
 # 2) Названия файлов (можете переименовать): qr_1m.jpg, qr_3m.jpg, qr_6m.jpg, qr_12m.jpg
-QR_FILES = {
-    "P1": "qr_1m.jpg",   # 1 месяц — 1499 ₽
-    "P3": "qr_3m.jpg",   # 3 месяца — 2999 ₽
-    "P6": "qr_6m.jpg",   # 6 месяцев — 5290 ₽
-    "P12": "qr_12m.jpg", # 12 месяцев — 9090 ₽
-}
-PAYMENT_PLANS: List[Tuple[str, str, int]] = [
-    ("P1", "1 месяц", 1499),
-    ("P3", "3 месяца", 2999),
-    ("P6", "6 месяцев", 5290),
-    ("P12", "12 месяцев + аудиокнига", 9090),
+# (ключ, название, сумма ₽, QR-файл)
+DEFAULT_PAYMENT_PLANS: List[Tuple[str, str, int, str]] = [
+    ("P1", "1 месяц", 1499, "qr_1m.jpg"),
+    ("P3", "3 месяца", 2999, "qr_3m.jpg"),
+    ("P6", "6 месяцев", 5290, "qr_6m.jpg"),
+    ("P12", "12 месяцев + аудиокнига", 9090, "qr_12m.jpg"),
 ]
-PLAN_TITLE = {k: t for k, t, _ in PAYMENT_PLANS}
-PLAN_PRICE = {k: p for k, _, p in PAYMENT_PLANS}
 
 # -------------------- Память (без JSON) --------------------
 @dataclass
@@ -75,6 +282,14 @@ class Attachment:
     file_id: str
     caption: str = ""
 
+# Карточка тикета в одной из групп поддержки
+@dataclass
+class Card:
+    chat_id: int
+    message_id: int
+    thread_id: Optional[int] = None
+    readonly: bool = False
+
 @dataclass
 class Ticket:
     ticket_id: int
@@ -85,22 +300,139 @@ class Ticket:
     category: str
     text: str
     attachments: List[Attachment] = field(default_factory=list)
-    group_message_id: Optional[int] = None
+    group_message_id: Optional[int] = None  # карточка в основной группе (cards[0])
     created_at: str = ""
+    cards: List[Card] = field(default_factory=list)
 
     # Добавлено для оплаты РФ:
     payment_plan: Optional[str] = None      # P1/P3/P6/P12
+    payment_plan_title: Optional[str] = None # название периода на момент оплаты
     payment_price_rub: Optional[int] = None # 1499/2999/...
     subscription_added: bool = False        # отмечено админом
 
     # Добавлено: email пользователя (для начисления подписки)
     payment_email: Optional[str] = None
 
+    # Добавлено: назначенный админ (подтверждает «🟡 В работе» или ответом)
+    assignee_id: Optional[int] = None
+    acknowledged: bool = False
+
+@dataclass
+class Admin:
+    admin_id: int
+    full_name: str
+    username: Optional[str] = None
+    online: bool = False
+    open_tickets: Set[int] = field(default_factory=set)
+    last_assigned: float = 0.0
+
 tickets: Dict[int, Ticket] = {}
 ticket_counter = 0
 
-# admin reply mode: admin_id -> ticket_id
-REPLY_MODE: Dict[int, int] = {}
+# admin reply mode: (chat_id, admin_id) -> ticket_id
+REPLY_MODE: Dict[Tuple[int, int], int] = {}
+
+# открытые тикеты пользователя: user_id -> ID по возрастанию (ведут register_ticket/set_status)
+USER_TICKETS: Dict[int, List[int]] = {}
+
+# Состояние процесса: для drain при остановке и health-check
+@dataclass
+class Runtime:
+    ready: bool = False
+    draining: bool = False
+    inflight: int = 0
+    idle: asyncio.Event = field(default_factory=asyncio.Event)
+    last_update_at: Optional[float] = None
+    loop_lag: float = 0.0
+    posting: Set[int] = field(default_factory=set)  # тикеты, карточки/вложения которых ещё отправляются
+    background: List[asyncio.Task] = field(default_factory=list)
+    health_runner: Any = None
+    profile_task: Optional[asyncio.Task] = None  # завершение сессии профилирования (запись файлов, сводка)
+    storage: Any = None       # FSM-хранилище диспетчера (таймеры проверяют шаг пользователя)
+    state_dirty: bool = False # есть несохранённые изменения для STATE_FILE (кроме таймеров)
+
+RUNTIME = Runtime()
+RUNTIME.idle.set()
+
+# тикеты, изменённые после последнего сохранения: save_state сериализует только их
+DIRTY_TICKETS: Set[int] = set()
+
+def mark_dirty(t: Optional[Ticket] = None):
+    RUNTIME.state_dirty = True
+    if t is not None:
+        DIRTY_TICKETS.add(t.ticket_id)
+
+# назначение: admin_id -> Admin
+ADMINS: Dict[int, Admin] = {}
+# тикеты, которые некому было назначить (порядок = очередь)
+UNASSIGNED: Dict[int, None] = {}
+
+# Таймеры: куча (срок, seq, вид, ключ) и актуальный (срок, seq) для каждой пары (вид, ключ).
+# Перенос и отмена — O(log n)/O(1) без поиска в куче: устаревшая запись пропускается при извлечении,
+# а когда таких становится больше половины, куча пересобирается. Сроки — time.time(),
+# чтобы снимок в STATE_FILE оставался верным после перезапуска.
+class Scheduler:
+    def __init__(self):
+        self.heap: List[Tuple[float, int, str, int]] = []
+        self.active: Dict[Tuple[str, int], Tuple[float, int]] = {}
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.dirty = False  # менялись после последнего сохранения
+
+    def schedule(self, kind: str, key: int, due: float):
+        seq = next(self.seq)
+        self.active[(kind, key)] = (due, seq)
+        self.dirty = True
+        heapq.heappush(self.heap, (due, seq, kind, key))
+        if self.heap[0][1] == seq:
+            self.wakeup.set()
+        if len(self.heap) > 2 * len(self.active) + 64:
+            self.heap = [(due, seq, kind, key) for (kind, key), (due, seq) in self.active.items()]
+            heapq.heapify(self.heap)
+
+    def cancel(self, kind: str, key: int):
+        if self.active.pop((kind, key), None) is not None:
+            self.dirty = True
+
+    def _is_current(self, entry: Tuple[float, int, str, int]) -> bool:
+        current = self.active.get((entry[2], entry[3]))
+        return current is not None and current[1] == entry[1]
+
+    def next_due(self) -> Optional[float]:
+        while self.heap and not self._is_current(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: float) -> List[Tuple[str, int]]:
+        fired = []
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if self._is_current(entry):
+                del self.active[(entry[2], entry[3])]
+                fired.append((entry[2], entry[3]))
+        self.dirty = self.dirty or bool(fired)
+        return fired
+
+    def snapshot(self) -> List[list]:
+        return [[due, kind, key] for (kind, key), (due, _) in self.active.items()]
+
+    def restore(self, rows: List[list]):
+        self.heap = []
+        self.active = {}
+        for due, kind, key in rows:
+            self.schedule(kind, key, due)
+        self.dirty = False
+
+TIMERS = Scheduler()
+
+# ожидание чека (таймер "receipt"): user_id -> данные оплаты из FSM. Сохраняются в STATE_FILE
+# вместе с таймером, чтобы после перезапуска (FSM в памяти) вернуть пользователя на шаг чека.
+RECEIPT_WAITS: Dict[int, Dict[str, Any]] = {}
+RECEIPT_WAIT_KEYS = ("category", "payment_plan", "payment_plan_title", "payment_price", "payment_qr", "payment_email")
+
+def forget_receipt_wait(user_id: int):
+    RECEIPT_WAITS.pop(user_id, None)
+    TIMERS.cancel("receipt", user_id)
 
 # -------------------- FSM --------------------
 class Flow(StatesGroup):
@@ -117,44 +449,40 @@ class Flow(StatesGroup):
 # -------------------- UI клавиатуры --------------------
 def kb_start() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Создать обращение", callback_data="u:new")],
+        [InlineKeyboardButton(text="➕ Создать обращение", callback_data=cb("u:new"))],
     ])
 
 def kb_after_user() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Новое обращение", callback_data="u:new")],
-        [InlineKeyboardButton(text="🏠 В начало", callback_data="u:home")],
+        [InlineKeyboardButton(text="➕ Новое обращение", callback_data=cb("u:new"))],
+        [InlineKeyboardButton(text="🏠 В начало", callback_data=cb("u:home"))],
     ])
 
 def kb_categories() -> InlineKeyboardMarkup:
-    rows = []
-    for code, title in CATEGORIES:
-        rows.append([InlineKeyboardButton(text=title, callback_data=f"u:cat:{code}")])
-    rows.append([InlineKeyboardButton(text="🏠 В начало", callback_data="u:home")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+    return get_catalog().kb_categories
 
 def kb_collecting() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⬅️ Назад (категории)", callback_data="u:back_cat")],
-        [InlineKeyboardButton(text="🏠 В начало", callback_data="u:home")],
+        [InlineKeyboardButton(text="⬅️ Назад (категории)", callback_data=cb("u:back_cat"))],
+        [InlineKeyboardButton(text="🏠 В начало", callback_data=cb("u:home"))],
     ])
 
 def kb_confirm(can_send: bool) -> InlineKeyboardMarkup:
     rows = []
     if can_send:
-        rows.append([InlineKeyboardButton(text="✅ Подтвердить и отправить", callback_data="u:send")])
-    rows.append([InlineKeyboardButton(text="📎 Добавить файл", callback_data="u:add_file_tip")])
-    rows.append([InlineKeyboardButton(text="✏️ Изменить текст", callback_data="u:edit_text")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад (категории)", callback_data="u:back_cat")])
-    rows.append([InlineKeyboardButton(text="🏠 В начало", callback_data="u:home")])
+        rows.append([InlineKeyboardButton(text="✅ Подтвердить и отправить", callback_data=cb("u:send"))])
+    rows.append([InlineKeyboardButton(text="📎 Добавить файл", callback_data=cb("u:add_file_tip"))])
+    rows.append([InlineKeyboardButton(text="✏️ Изменить текст", callback_data=cb("u:edit_text"))])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад (категории)", callback_data=cb("u:back_cat"))])
+    rows.append([InlineKeyboardButton(text="🏠 В начало", callback_data=cb("u:home"))])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 def kb_admin(ticket_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="🟡 В работе", callback_data=f"a:work:{ticket_id}"),
-            InlineKeyboardButton(text="✉️ Ответить", callback_data=f"a:reply:{ticket_id}"),
-            InlineKeyboardButton(text="✅ Закрыть", callback_data=f"a:close:{ticket_id}"),
+            InlineKeyboardButton(text="🟡 В работе", callback_data=cb("a:work", ticket_id)),
+            InlineKeyboardButton(text="✉️ Ответить", callback_data=cb("a:reply", ticket_id)),
+            InlineKeyboardButton(text="✅ Закрыть", callback_data=cb("a:close", ticket_id)),
         ]
     ])
 
@@ -162,41 +490,218 @@ def kb_admin(ticket_id: int) -> InlineKeyboardMarkup:
 def kb_admin_payment(ticket_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
-            InlineKeyboardButton(text="✅ Подписка добавлена", callback_data=f"a:sub_added:{ticket_id}"),
+            InlineKeyboardButton(text="✅ Подписка добавлена", callback_data=cb("a:sub_added", ticket_id)),
         ],
         [
-            InlineKeyboardButton(text="🟡 В работе", callback_data=f"a:work:{ticket_id}"),
-            InlineKeyboardButton(text="✉️ Ответить", callback_data=f"a:reply:{ticket_id}"),
-            InlineKeyboardButton(text="✅ Закрыть", callback_data=f"a:close:{ticket_id}"),
+            InlineKeyboardButton(text="🟡 В работе", callback_data=cb("a:work", ticket_id)),
+            InlineKeyboardButton(text="✉️ Ответить", callback_data=cb("a:reply", ticket_id)),
+            InlineKeyboardButton(text="✅ Закрыть", callback_data=cb("a:close", ticket_id)),
         ]
     ])
 
 # Добавлено: выбор периода оплаты РФ
 def kb_payment_plans() -> InlineKeyboardMarkup:
-    rows = []
-    for key, title, price in PAYMENT_PLANS:
-        rows.append([InlineKeyboardButton(text=f"{title} — {price} ₽", callback_data=f"u:payplan:{key}")])
-    rows.append([InlineKeyboardButton(text="⬅️ Назад (категории)", callback_data="u:back_cat")])
-    rows.append([InlineKeyboardButton(text="🏠 В начало", callback_data="u:home")])
-    return InlineKeyboardMarkup(inline_keyboard=rows)
+    return get_catalog().kb_payment_plans
 
 # Добавлено: во время оплаты — связаться с админом
 def kb_payment_help() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="👤 Связаться с админом", callback_data="u:pay_contact_admin")],
-        [InlineKeyboardButton(text="⬅️ Назад (категории)", callback_data="u:back_cat")],
-        [InlineKeyboardButton(text="🏠 В начало", callback_data="u:home")],
+        [InlineKeyboardButton(text="👤 Связаться с админом", callback_data=cb("u:pay_contact_admin"))],
+        [InlineKeyboardButton(text="⬅️ Назад (категории)", callback_data=cb("u:back_cat"))],
+        [InlineKeyboardButton(text="🏠 В начало", callback_data=cb("u:home"))],
     ])
 
 # Добавлено: подтверждение данных оплаты (тариф + email)
 def kb_payment_confirm() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Всё верно", callback_data="u:pay_confirm_ok")],
-        [InlineKeyboardButton(text="✏️ Изменить email", callback_data="u:pay_change_email")],
-        [InlineKeyboardButton(text="🔁 Изменить период", callback_data="u:pay_change_plan")],
-        [InlineKeyboardButton(text="👤 Связаться с админом", callback_data="u:pay_contact_admin")],
-        [InlineKeyboardButton(text="🏠 В начало", callback_data="u:home")],
+        [InlineKeyboardButton(text="✅ Всё верно", callback_data=cb("u:pay_confirm_ok"))],
+        [InlineKeyboardButton(text="✏️ Изменить email", callback_data=cb("u:pay_change_email"))],
+        [InlineKeyboardButton(text="🔁 Изменить период", callback_data=cb("u:pay_change_plan"))],
+        [InlineKeyboardButton(text="👤 Связаться с админом", callback_data=cb("u:pay_contact_admin"))],
+        [InlineKeyboardButton(text="🏠 В начало", callback_data=cb("u:home"))],
+    ])
+
+# -------------------- Каталог (категории, тарифы) --------------------
+# Всё, что зависит от config.json, собрано в один неизменяемый объект. Перезагрузка
+# собирает новый Catalog и подменяет ссылку целиком, поэтому обработчик видит либо
+# старую, либо новую версию — но не смесь. Тикеты и начатые оплаты хранят свои
+# период/сумму и от перезагрузки не зависят.
+CATALOG_CODE_RE = re.compile(r"^[A-Za-z0-9_]{1,32}$")
+
+@dataclass(frozen=True)
+class Catalog:
+    max_attachments: int
+    categories: Tuple[Tuple[str, str], ...]
+    cat_title: Mapping[str, str]
+    plans: Tuple[Tuple[str, str, int], ...]
+    plan_title: Mapping[str, str]
+    plan_price: Mapping[str, int]
+    qr_files: Mapping[str, str]
+    kb_categories: InlineKeyboardMarkup
+    kb_payment_plans: InlineKeyboardMarkup
+    source: str = "по умолчанию"
+    mtime: Optional[float] = None
+
+CATALOG: Optional[Catalog] = None
+
+def default_catalog_config() -> Dict[str, Any]:
+    return {
+        "max_attachments": DEFAULT_MAX_ATTACHMENTS,
+        "categories": [{"code": c, "title": t} for c, t in DEFAULT_CATEGORIES],
+        "payment_plans": [
+            {"key": k, "title": t, "price_rub": p, "qr_file": qr} for k, t, p, qr in DEFAULT_PAYMENT_PLANS
+        ],
+    }
+
+def catalog_list(raw: Dict[str, Any], key: str, errors: List[str]) -> List[Any]:
+    value = raw.get(key)
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        errors.append(f"{key}: ожидается список")
+        return []
+    return value
+
+def compile_catalog(raw: Any, source: str = "по умолчанию", mtime: Optional[float] = None) -> Catalog:
+    if not isinstance(raw, dict):
+        raise ValueError("ожидается JSON-объект")
+    errors: List[str] = []
+
+    max_attachments = raw.get("max_attachments", DEFAULT_MAX_ATTACHMENTS)
+    if not isinstance(max_attachments, int) or isinstance(max_attachments, bool) or not 1 <= max_attachments <= 10:
+        errors.append("max_attachments: целое от 1 до 10")
+
+    categories: List[Tuple[str, str]] = []
+    for i, item in enumerate(catalog_list(raw, "categories", errors)):
+        code = item.get("code") if isinstance(item, dict) else None
+        title = item.get("title") if isinstance(item, dict) else None
+        if not isinstance(code, str) or not CATALOG_CODE_RE.match(code):
+            errors.append(f"categories[{i}].code: латиница/цифры/_, до 32 символов")
+        elif not isinstance(title, str) or not title.strip():
+            errors.append(f"categories[{i}].title: пустое название")
+        elif any(code == c for c, _ in categories):
+            errors.append(f"categories[{i}]: повтор кода {code}")
+        else:
+            categories.append((code, title.strip()))
+    if not categories:
+        errors.append("categories: нужна хотя бы одна категория")
+
+    plans: List[Tuple[str, str, int]] = []
+    qr_files: Dict[str, str] = {}
+    for i, item in enumerate(catalog_list(raw, "payment_plans", errors)):
+        if not isinstance(item, dict):
+            errors.append(f"payment_plans[{i}]: ожидается объект")
+            continue
+        key, title, price, qr = item.get("key"), item.get("title"), item.get("price_rub"), item.get("qr_file")
+        if not isinstance(key, str) or not CATALOG_CODE_RE.match(key):
+            errors.append(f"payment_plans[{i}].key: латиница/цифры/_, до 32 символов")
+        elif any(key == k for k, _, _ in plans):
+            errors.append(f"payment_plans[{i}]: повтор ключа {key}")
+        elif not isinstance(title, str) or not title.strip():
+            errors.append(f"payment_plans[{i}].title: пустое название")
+        elif not isinstance(price, int) or isinstance(price, bool) or price <= 0:
+            errors.append(f"payment_plans[{i}].price_rub: положительное целое")
+        elif qr is not None and (not isinstance(qr, str) or not qr):
+            errors.append(f"payment_plans[{i}].qr_file: путь к файлу")
+        else:
+            plans.append((key, title.strip(), price))
+            if qr:
+                qr_files[key] = qr
+
+    if errors:
+        raise ValueError("; ".join(errors))
+
+    kb_cats = InlineKeyboardMarkup(inline_keyboard=[
+        *[[InlineKeyboardButton(text=title, callback_data=cb("u:cat", code))] for code, title in categories],
+        [InlineKeyboardButton(text="🏠 В начало", callback_data=cb("u:home"))],
+    ])
+    kb_plans = InlineKeyboardMarkup(inline_keyboard=[
+        *[
+            [InlineKeyboardButton(text=f"{title} — {price} ₽", callback_data=cb("u:payplan", key))]
+            for key, title, price in plans
+        ],
+        [InlineKeyboardButton(text="⬅️ Назад (категории)", callback_data=cb("u:back_cat"))],
+        [InlineKeyboardButton(text="🏠 В начало", callback_data=cb("u:home"))],
     ])
+    return Catalog(
+        max_attachments=max_attachments,
+        categories=tuple(categories),
+        cat_title=MappingProxyType(dict(categories)),
+        plans=tuple(plans),
+        plan_title=MappingProxyType({k: t for k, t, _ in plans}),
+        plan_price=MappingProxyType({k: p for k, _, p in plans}),
+        qr_files=MappingProxyType(qr_files),
+        kb_categories=kb_cats,
+        kb_payment_plans=kb_plans,
+        source=source,
+        mtime=mtime,
+    )
+
+def read_catalog(path: str) -> Catalog:
+    if not os.path.exists(path):
+        return compile_catalog(default_catalog_config())
+    mtime = os.stat(path).st_mtime
+    with open(path, encoding="utf-8") as f:
+        try:
+            raw = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"некорректный JSON: {e}")
+    return compile_catalog(raw, source=path, mtime=mtime)
+
+def get_catalog() -> Catalog:
+    global CATALOG
+    if CATALOG is None:
+        path = get_settings().config_path
+        try:
+            CATALOG = read_catalog(path)
+        except ValueError as e:
+            raise RuntimeError(f"Ошибка в {path}: {e}")
+    return CATALOG
+
+def reload_catalog() -> Tuple[bool, str]:
+    global CATALOG
+    path = get_settings().config_path
+    try:
+        new = read_catalog(path)
+    except (OSError, ValueError) as e:
+        return False, f"⚠️ {path} не применён, работаем на прежней версии.\n{e}"
+    CATALOG = new
+    missing = [path for path in new.qr_files.values() if not os.path.exists(path)]
+    text = (
+        f"🔄 Настройки обновлены ({new.source}): категорий {len(new.categories)}, "
+        f"тарифов {len(new.plans)}, вложений до {new.max_attachments}."
+    )
+    if missing:
+        text += "\n⚠️ Не найдены QR-файлы: " + ", ".join(missing)
+    return True, text
+
+async def watch_catalog(bot: Bot):
+    seen = get_catalog().mtime
+    settings = get_settings()
+    while True:
+        await asyncio.sleep(settings.config_watch_interval)
+        try:
+            mtime = os.stat(settings.config_path).st_mtime
+        except OSError:
+            continue
+        if mtime == seen:
+            continue
+        # ошибку в файле сообщаем один раз — до следующего сохранения
+        seen = mtime
+        try:
+            ok, text = reload_catalog()
+        except Exception:
+            # наблюдатель не должен умирать: иначе горячая перезагрузка молча прекратится
+            logger.exception("Не удалось перечитать %s", settings.config_path)
+            continue
+        if ok:
+            logger.info(text)
+            continue
+        logger.error(text)
+        try:
+            await bot.send_message(get_settings().support_chat_id, text)
+        except Exception:
+            pass
 
 # -------------------- Helpers --------------------
 def user_card(user_id: int, username: Optional[str], full_name: str) -> str:
@@ -209,12 +714,27 @@ def user_card(user_id: int, username: Optional[str], full_name: str) -> str:
         f"🔗 Написать: {link}"
     )
 
+def admin_label(admin_id: int) -> str:
+    a = ADMINS.get(admin_id)
+    if not a:
+        return f"ID {admin_id}"
+    return f"@{a.username}" if a.username else a.full_name
+
 def render_ticket_text(t: Ticket) -> str:
-    cat = CAT_TITLE.get(t.category, t.category)
+    catalog = get_catalog()
+    cat = catalog.cat_title.get(t.category, t.category)
+
+    if t.assignee_id is None:
+        assignee = "не назначен"
+    elif t.acknowledged:
+        assignee = admin_label(t.assignee_id)
+    else:
+        assignee = f"{admin_label(t.assignee_id)} (ждём подтверждения)"
 
     extra = ""
     if t.category == "PAYMENT_RU":
-        plan = PLAN_TITLE.get(t.payment_plan or "", "—")
+        # период и сумма — те, что были при создании тикета
+        plan = t.payment_plan_title or catalog.plan_title.get(t.payment_plan or "", "—")
         price = f"{t.payment_price_rub} ₽" if t.payment_price_rub else "—"
         email = t.payment_email or "—"
         mark = "✅ Подписка добавлена" if t.subscription_added else "⏳ Ожидаем чек/проверку"
@@ -228,7 +748,8 @@ def render_ticket_text(t: Ticket) -> str:
 
     return (
         f"📩 ОБРАЩЕНИЕ #{t.ticket_id}\n"
-        f"Статус: {STATUS_LABEL.get(t.status, t.status)}\n\n"
+        f"Статус: {STATUS_LABEL.get(t.status, t.status)}\n"
+        f"👤 Исполнитель: {assignee}\n\n"
         f"{user_card(t.user_id, t.username, t.full_name)}\n\n"
         f"📌 Категория: {cat}\n\n"
         f"💬 Сообщение:\n{t.text}"
@@ -253,7 +774,7 @@ def extract_attachment(msg: Message) -> Optional[Attachment]:
 async def add_att(state: FSMContext, att: Attachment) -> bool:
     data = await state.get_data()
     atts: List[Attachment] = data.get("attachments", [])
-    if len(atts) >= MAX_ATTACHMENTS:
+    if len(atts) >= get_catalog().max_attachments:
         return False
     atts.append(att)
     await state.update_data(attachments=atts)
@@ -264,7 +785,7 @@ def atts_count(data: dict) -> int:
 
 def confirm_text(data: dict) -> str:
     cat_code = data.get("category")
-    cat = CAT_TITLE.get(cat_code, cat_code or "—")
+    cat = get_catalog().cat_title.get(cat_code, cat_code or "—")
     text = data.get("text") or ""
     cnt = atts_count(data)
     parts = [
@@ -277,8 +798,7 @@ def confirm_text(data: dict) -> str:
     ]
     return "\n".join(parts)
 
-def safe_qr_inputfile(plan_key: str) -> Optional[FSInputFile]:
-    path = QR_FILES.get(plan_key)
+def safe_qr_inputfile(path: Optional[str]) -> Optional[FSInputFile]:
     if not path:
         return None
     if not os.path.exists(path):
@@ -303,9 +823,8 @@ def is_valid_email(s: str) -> bool:
 
 # Добавлено: текст подтверждения оплаты
 def payment_confirm_text(data: dict) -> str:
-    plan_key = data.get("payment_plan")
-    title = PLAN_TITLE.get(plan_key or "", "—")
-    price = PLAN_PRICE.get(plan_key or "", "—")
+    title = data.get("payment_plan_title") or "—"
+    price = data.get("payment_price") or "—"
     email = data.get("payment_email") or "—"
     return (
         "🧾 Проверьте данные перед оплатой:\n\n"
@@ -316,13 +835,493 @@ def payment_confirm_text(data: dict) -> str:
         "После этого мы покажем QR-код, и вы сможете отправить чек."
     )
 
+# -------------------- Карточки в группах --------------------
+def kb_for_card(t: Ticket, card: Card) -> Optional[InlineKeyboardMarkup]:
+    if card.readonly:
+        return None
+    # Для оплаты РФ — другая клавиатура
+    return kb_admin_payment(t.ticket_id) if t.category == "PAYMENT_RU" else kb_admin(t.ticket_id)
+
+async def send_attachment(bot: Bot, chat_id: int, att: Attachment, caption: Optional[str] = None, **kwargs) -> Message:
+    if att.kind == "photo":
+        return await bot.send_photo(chat_id, att.file_id, caption=caption, **kwargs)
+    if att.kind == "video":
+        return await bot.send_video(chat_id, att.file_id, caption=caption, **kwargs)
+    if att.kind == "document":
+        return await bot.send_document(chat_id, att.file_id, caption=caption, **kwargs)
+    if att.kind == "video_note":
+        return await bot.send_video_note(chat_id, att.file_id, **kwargs)
+    if att.kind == "voice":
+        return await bot.send_voice(chat_id, att.file_id, caption=caption, **kwargs)
+    if att.kind == "audio":
+        return await bot.send_audio(chat_id, att.file_id, caption=caption, **kwargs)
+    raise ValueError(f"Неизвестный тип вложения: {att.kind}")
+
+# Альбомом (send_media_group) Telegram принимает фото вместе с видео, документы с документами
+# и аудио с аудио, от 2 до 10 штук; голосовые и кружки — только отдельными сообщениями.
+MEDIA_GROUP_OF = {"photo": "visual", "video": "visual", "document": "document", "audio": "audio"}
+MEDIA_GROUP_MAX = 10
+CAPTION_MAX = 1024
+
+def group_attachments(atts: List[Attachment]) -> List[List[Attachment]]:
+    posts: List[List[Attachment]] = []
+    open_groups: Dict[str, List[Attachment]] = {}
+    for a in atts:
+        kind = MEDIA_GROUP_OF.get(a.kind)
+        if kind is None:
+            posts.append([a])
+            continue
+        group = open_groups.get(kind)
+        if group is None or len(group) == MEDIA_GROUP_MAX:
+            group = open_groups[kind] = []
+            posts.append(group)
+        group.append(a)
+    return posts
+
+async def send_attachment_post(bot: Bot, chat_id: int, atts: List[Attachment], captions: List[Optional[str]], **kwargs):
+    if len(atts) == 1:
+        await send_attachment(bot, chat_id, atts[0], caption=captions[0], **kwargs)
+        return
+    media_cls = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument, "audio": InputMediaAudio}
+    media = [media_cls[a.kind](media=a.file_id, caption=cap) for a, cap in zip(atts, captions)]
+    await bot.send_media_group(chat_id, media=media, **kwargs)
+
+async def post_ticket(bot: Bot, t: Ticket, receipt: bool = False):
+    RUNTIME.posting.add(t.ticket_id)
+    try:
+        await _post_ticket(bot, t, receipt)
+    finally:
+        RUNTIME.posting.discard(t.ticket_id)
+
+async def _post_ticket(bot: Bot, t: Ticket, receipt: bool):
+    # карточка в каждую группу маршрута, вложения — реплаями (кроме ro-лент)
+    for dest in route_for(t.category):
+        card = Card(chat_id=dest.chat_id, message_id=0, thread_id=dest.thread_id, readonly=dest.readonly)
+        try:
+            sent = await bot.send_message(
+                chat_id=dest.chat_id,
+                message_thread_id=dest.thread_id,
+                text=render_ticket_text(t),
+                reply_markup=kb_for_card(t, card)
+            )
+        except Exception:
+            if t.cards or dest.readonly:
+                continue
+            raise
+        card.message_id = sent.message_id
+        t.cards.append(card)
+        mark_dirty(t)
+        if t.group_message_id is None and not dest.readonly:
+            t.group_message_id = sent.message_id
+        if dest.readonly:
+            continue
+
+        for a in t.attachments:
+            cap = "🧾 Чек/скрин оплаты" if receipt else (a.caption or None)
+            try:
+                await send_attachment(
+                    bot, dest.chat_id, a, caption=cap,
+                    message_thread_id=dest.thread_id, reply_to_message_id=sent.message_id
+                )
+            except Exception:
+                what = "чек" if receipt else f"вложение (тип: {a.kind})"
+                await bot.send_message(
+                    dest.chat_id,
+                    f"⚠️ Не удалось отправить {what} к обращению #{t.ticket_id}.",
+                    message_thread_id=dest.thread_id
+                )
+
+def primary_card(t: Ticket) -> Optional[Card]:
+    return next((c for c in t.cards if not c.readonly), None)
+
+def ticket_in_chat(t: Ticket, chat_id: int) -> bool:
+    return any(c.chat_id == chat_id for c in t.cards)
+
+# -------------------- Назначение админов (least-loaded) --------------------
+def ensure_admin(user) -> Admin:
+    a = ADMINS.get(user.id)
+    if not a:
+        a = Admin(admin_id=user.id, full_name=user.full_name or "Админ", username=user.username)
+        ADMINS[user.id] = a
+        mark_dirty()
+    elif (a.full_name, a.username) != (user.full_name or a.full_name, user.username):
+        a.full_name = user.full_name or a.full_name
+        a.username = user.username
+        mark_dirty()
+    return a
+
+def pick_admin(category: str, exclude: Set[int] = frozenset()) -> Optional[Admin]:
+    allowed = get_settings().assign_rules.get(category)
+    best: Optional[Admin] = None
+    for a in ADMINS.values():
+        if not a.online or a.admin_id in exclude:
+            continue
+        if allowed is not None and a.admin_id not in allowed:
+            continue
+        # меньше открытых тикетов; при равенстве — кто дольше не получал новых
+        if best is None or (len(a.open_tickets), a.last_assigned) < (len(best.open_tickets), best.last_assigned):
+            best = a
+    return best
+
+def release_ticket(t: Ticket):
+    if t.assignee_id is not None and t.assignee_id in ADMINS:
+        ADMINS[t.assignee_id].open_tickets.discard(t.ticket_id)
+    TIMERS.cancel("ack", t.ticket_id)
+    UNASSIGNED.pop(t.ticket_id, None)
+
+def set_assignee(t: Ticket, admin_id: Optional[int], acknowledged: bool = False):
+    release_ticket(t)
+    t.assignee_id = admin_id
+    t.acknowledged = acknowledged
+    mark_dirty(t)
+    if admin_id is None:
+        UNASSIGNED[t.ticket_id] = None
+        return
+    a = ADMINS.get(admin_id)
+    if a:
+        a.open_tickets.add(t.ticket_id)
+        a.last_assigned = time.monotonic()
+    if not acknowledged:
+        TIMERS.schedule("ack", t.ticket_id, time.time() + get_settings().assign_ack_timeout)
+
+def auto_assign(t: Ticket, exclude: Set[int] = frozenset()) -> Optional[Admin]:
+    a = pick_admin(t.category, exclude)
+    set_assignee(t, a.admin_id if a else None)
+    return a
+
+# Админ взял тикет (кнопка/ответ). Возвращает прежнего исполнителя, если тикет перехвачен.
+def acknowledge(t: Ticket, user) -> Optional[int]:
+    ensure_admin(user)
+    prev = t.assignee_id
+    if prev == user.id:
+        t.acknowledged = True
+        mark_dirty(t)
+        TIMERS.cancel("ack", t.ticket_id)
+        return None
+    set_assignee(t, user.id, acknowledged=True)
+    return prev
+
+# Исполнитель не подтвердил тикет вовремя (таймер "ack") или ушёл офлайн
+async def reassign_unacknowledged(bot: Bot, t: Ticket):
+    prev = t.assignee_id
+    a = pick_admin(t.category, exclude={prev} if prev is not None else frozenset())
+    if not a:
+        if prev is not None and prev in ADMINS and not ADMINS[prev].online:
+            # исполнитель ушёл офлайн, а заменить некому — возвращаем в очередь
+            set_assignee(t, None)
+            await update_group_card(bot, t)
+        else:
+            # переназначить некому — ждём ещё один интервал
+            TIMERS.schedule("ack", t.ticket_id, time.time() + get_settings().assign_ack_timeout)
+        return
+    set_assignee(t, a.admin_id)
+    await update_group_card(bot, t)
+    await notify_assignee(bot, t, f"🔁 Обращение #{t.ticket_id} переназначено: "
+                                  f"{admin_label(prev) if prev is not None else '—'} не подтвердил(а) "
+                                  f"за {get_settings().assign_ack_timeout // 60} мин.")
+
+async def assign_backlog(bot: Bot):
+    for tid in list(UNASSIGNED):
+        t = tickets.get(tid)
+        if not t or t.status == "closed":
+            UNASSIGNED.pop(tid, None)
+            continue
+        if not auto_assign(t):
+            continue
+        await update_group_card(bot, t)
+        await notify_assignee(bot, t, f"📥 Обращение #{t.ticket_id} из очереди.")
+
+async def notify_assignee(bot: Bot, t: Ticket, reason: str):
+    # правка карточки не уведомляет, поэтому упоминаем исполнителя отдельным ответом
+    card = primary_card(t)
+    if t.assignee_id is None or not card:
+        return
+    try:
+        await bot.send_message(
+            card.chat_id,
+            f"{reason}\n👤 Исполнитель: {admin_label(t.assignee_id)}",
+            message_thread_id=card.thread_id,
+            reply_to_message_id=card.message_id,
+        )
+    except Exception:
+        pass
+
+def admins_status_text() -> str:
+    online = [a for a in ADMINS.values() if a.online]
+    if not online:
+        return "Сейчас никого нет онлайн — новые обращения ждут в очереди."
+    lines = [f"• {admin_label(a.admin_id)} — открытых: {len(a.open_tickets)}" for a in online]
+    return "🟢 Онлайн:\n" + "\n".join(lines)
+
+# -------------------- Дашборд очереди --------------------
+# Счётчики (и USER_TICKETS) меняются только через register_ticket/set_status/mark_subscription_added,
+# поэтому сводка строится без обхода tickets.
+@dataclass
+class QueueStats:
+    by_status: Counter = field(default_factory=Counter)
+    open_by_category: Counter = field(default_factory=Counter)
+    pending_payments: int = 0                            # PAYMENT_RU без «Подписка добавлена»
+    open_heap: List[int] = field(default_factory=list)   # ID открытых (закрытые удаляются лениво)
+
+@dataclass
+class Dashboard:
+    message_id: Optional[int] = None
+    body: str = ""
+
+STATS = QueueStats()
+DASHBOARD = Dashboard()
+
+def is_pending_payment(t: Ticket) -> bool:
+    return t.category == "PAYMENT_RU" and not t.subscription_added and t.status != "closed"
+
+def register_ticket(t: Ticket):
+    tickets[t.ticket_id] = t
+    mark_dirty(t)
+    STATS.by_status[t.status] += 1
+    if t.status != "closed":
+        STATS.open_by_category[t.category] += 1
+        heapq.heappush(STATS.open_heap, t.ticket_id)
+        bisect.insort(USER_TICKETS.setdefault(t.user_id, []), t.ticket_id)
+    STATS.pending_payments += is_pending_payment(t)
+    sync_ticket_timers(t)
+
+def set_status(t: Ticket, status: str):
+    if t.status == status:
+        return
+    was_pending = is_pending_payment(t)
+    STATS.by_status[t.status] -= 1
+    STATS.by_status[status] += 1
+    if status == "closed":
+        STATS.open_by_category[t.category] -= 1
+        release_ticket(t)
+        open_ids = USER_TICKETS.get(t.user_id, [])
+        if t.ticket_id in open_ids:
+            open_ids.remove(t.ticket_id)
+        if not open_ids:
+            USER_TICKETS.pop(t.user_id, None)
+    elif t.status == "closed":
+        STATS.open_by_category[t.category] += 1
+        heapq.heappush(STATS.open_heap, t.ticket_id)
+        bisect.insort(USER_TICKETS.setdefault(t.user_id, []), t.ticket_id)
+    t.status = status
+    mark_dirty(t)
+    STATS.pending_payments += is_pending_payment(t) - was_pending
+    sync_ticket_timers(t)
+
+# SLA-напоминание живёт, пока тикет «Новое»; автозакрытие — пока «В работе»
+def sync_ticket_timers(t: Ticket):
+    settings = get_settings()
+    if t.status == "new" and settings.sla_new_after > 0:
+        TIMERS.schedule("sla", t.ticket_id, time.time() + settings.sla_new_after)
+    else:
+        TIMERS.cancel("sla", t.ticket_id)
+    if t.status == "in_work" and settings.stale_close_after > 0:
+        TIMERS.schedule("stale", t.ticket_id, time.time() + settings.stale_close_after)
+    else:
+        TIMERS.cancel("stale", t.ticket_id)
+
+# новое сообщение по тикету в работе откладывает автозакрытие
+def touch_ticket(t: Ticket):
+    stale_after = get_settings().stale_close_after
+    if t.status == "in_work" and stale_after > 0:
+        TIMERS.schedule("stale", t.ticket_id, time.time() + stale_after)
+
+def mark_subscription_added(t: Ticket):
+    was_pending = is_pending_payment(t)
+    t.subscription_added = True
+    mark_dirty(t)
+    STATS.pending_payments -= was_pending
+
+def oldest_open_ticket() -> Optional[Ticket]:
+    heap = STATS.open_heap
+    while heap:
+        t = tickets.get(heap[0])
+        if t and t.status != "closed":
+            return t
+        heapq.heappop(heap)
+    return None
+
+def format_age(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    hours, minutes = divmod(minutes, 60)
+    if hours < 24:
+        return f"{hours} ч {minutes} мин"
+    days, hours = divmod(hours, 24)
+    return f"{days} д {hours} ч"
+
+def render_dashboard_body() -> str:
+    lines = [
+        "📊 Очередь поддержки",
+        " · ".join(f"{STATUS_LABEL[st]}: {STATS.by_status[st]}" for st in STATUS_LABEL),
+    ]
+    oldest = oldest_open_ticket()
+    if oldest:
+        # время создания, а не возраст: иначе текст менялся бы каждую минуту и дашборд
+        # правился бы на каждом тике без событий по тикетам
+        created = datetime.strptime(oldest.created_at, "%Y-%m-%d %H:%M:%S")
+        lines.append(f"⏳ Старейшее открытое: #{oldest.ticket_id}, с {created.strftime('%d.%m %H:%M')} UTC")
+    else:
+        lines.append("⏳ Открытых обращений нет")
+    lines.append(f"💳 Оплата РФ ждёт «Подписка добавлена»: {STATS.pending_payments}")
+    lines.append(f"👤 Без исполнителя: {len(UNASSIGNED)}")
+
+    open_cats = [(code, n) for code, n in STATS.open_by_category.items() if n > 0]
+    if open_cats:
+        lines.append("\nОткрытые по категориям:")
+        for code, n in sorted(open_cats, key=lambda x: -x[1]):
+            lines.append(f"{get_catalog().cat_title.get(code, code)}: {n}")
+    return "\n".join(lines)
+
+async def refresh_dashboard(bot: Bot):
+    # сводка собирается из счётчиков; правим сообщение, только если она изменилась
+    body = render_dashboard_body()
+    if body == DASHBOARD.body and DASHBOARD.message_id:
+        return
+    text = body + f"\n\n🕒 Обновлено: {datetime.utcnow().strftime('%H:%M')} UTC"
+
+    chat_id = get_settings().support_chat_id
+    if DASHBOARD.message_id:
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=DASHBOARD.message_id, text=text)
+            DASHBOARD.body = body
+            return
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                DASHBOARD.body = body
+                return
+            # сообщение удалили — отправим и закрепим заново
+            DASHBOARD.message_id = None
+            mark_dirty()
+
+    sent = await bot.send_message(chat_id, text)
+    DASHBOARD.message_id = sent.message_id
+    mark_dirty()
+    DASHBOARD.body = body
+    try:
+        await bot.pin_chat_message(chat_id, sent.message_id, disable_notification=True)
+    except Exception:
+        logger.warning("Не удалось закрепить дашборд (нужны права администратора)")
+
+async def dashboard_loop(bot: Bot):
+    # не чаще раза в DASHBOARD_INTERVAL: сводка не должна отнимать лимит правок у карточек
+    while True:
+        try:
+            await refresh_dashboard(bot)
+        except Exception:
+            logger.exception("Не удалось обновить дашборд")
+        await asyncio.sleep(get_settings().dashboard_interval)
+
 # -------------------- Router --------------------
 router = Router()
 
+# группы поддержки известны только после get_settings(), поэтому фильтр — функция, а не F.chat.id.in_(...)
+def is_support_chat(message: Message) -> bool:
+    return message.chat.id in get_settings().support_chats
+
+# -------------------- Callback data --------------------
+# Формат: "<версия><код>[:<аргумент>][.<подпись>]", например "1un", "1uc:BUG", "1aw:42.Qm3x0aBc".
+# Код начинается с u (кнопки пользователя) или a (кнопки админов). Админские кнопки
+# подписаны коротким HMAC от BOT_TOKEN (Settings.cb_secret), поэтому подделанные и устаревшие кнопки
+# отбрасываются разбором строки, без поиска тикета. Все кнопки обслуживает один
+# обработчик: код -> действие из таблицы CB_ACTIONS.
+CB_VERSION = "1"
+CB_MAX_BYTES = 64  # лимит Telegram на callback_data
+
+@dataclass(frozen=True)
+class CallbackAction:
+    name: str                            # читаемое имя, например "a:work"
+    code: str                            # код в callback_data, например "aw"
+    handler: Callable[..., Awaitable[Any]]
+    arg: Optional[type] = None           # int/str — тип аргумента, None — без аргумента
+    states: Optional[FrozenSet[str]] = None  # в каких FSM-состояниях кнопка активна (None — в любых)
+    params: FrozenSet[str] = frozenset()     # какие из state/bot/arg принимает обработчик
+
+CB_ACTIONS: Dict[str, CallbackAction] = {}  # code -> действие
+CB_CODES: Dict[str, str] = {}               # name -> code
+
+def callback_action(name: str, code: str, *states: State, arg: Optional[type] = None):
+    def register(handler):
+        if code in CB_ACTIONS or name in CB_CODES or code[:1] not in ("u", "a"):
+            raise RuntimeError(f"Некорректное или повторное действие кнопки: {name} ({code})")
+        params = frozenset(inspect.signature(handler).parameters) & {"state", "bot", "arg"}
+        CB_ACTIONS[code] = CallbackAction(
+            name=name,
+            code=code,
+            handler=handler,
+            arg=arg,
+            states=frozenset(st.state for st in states) or None,
+            params=params,
+        )
+        CB_CODES[name] = code
+        return handler
+    return register
+
+def cb_sign(payload: str) -> str:
+    digest = hmac.new(get_settings().cb_secret, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:6]).decode()
+
+def cb(name: str, arg: Any = None) -> str:
+    action = CB_ACTIONS[CB_CODES[name]]
+    payload = CB_VERSION + action.code
+    if action.arg is not None:
+        payload += f":{arg}"
+    if action.code[0] == "a":
+        payload += "." + cb_sign(payload)
+    if len(payload.encode()) > CB_MAX_BYTES:
+        raise ValueError(f"callback_data длиннее {CB_MAX_BYTES} байт: {payload!r}")
+    return payload
+
+def parse_callback(data: str) -> Optional[Tuple[CallbackAction, Any]]:
+    if not data.startswith(CB_VERSION):
+        return None
+    body = data[len(CB_VERSION):]
+    if body[:1] == "a":
+        body, _, sig = body.rpartition(".")
+        # подпись — 8 символов urlsafe-base64; остальное отбрасываем без HMAC
+        # (compare_digest на str с не-ASCII падает с TypeError)
+        if len(sig) != 8 or not sig.isascii():
+            return None
+        if not hmac.compare_digest(sig.encode(), cb_sign(CB_VERSION + body).encode()):
+            return None
+    code, sep, raw = body.partition(":")
+    action = CB_ACTIONS.get(code)
+    if action is None or bool(sep) != (action.arg is not None):
+        return None
+    if action.arg is None:
+        return action, None
+    try:
+        return action, action.arg(raw)
+    except ValueError:
+        return None
+
+@router.callback_query()
+async def dispatch_callback(call: CallbackQuery, state: FSMContext, bot: Bot):
+    parsed = parse_callback(call.data or "")
+    if parsed is None:
+        await call.answer("Кнопка устарела. Откройте меню заново: /start", show_alert=True)
+        return
+    action, arg = parsed
+    if action.states is not None and await state.get_state() not in action.states:
+        # кнопка из прошлого шага сценария — просто гасим «часики»
+        await call.answer()
+        return
+
+    kwargs: Dict[str, Any] = {}
+    if "state" in action.params:
+        kwargs["state"] = state
+    if "bot" in action.params:
+        kwargs["bot"] = bot
+    if "arg" in action.params:
+        kwargs["arg"] = arg
+    await action.handler(call, **kwargs)
+
 # -------------------- Пользователь --------------------
 @router.message(CommandStart())
 async def start(message: Message, state: FSMContext):
     await state.clear()
+    forget_receipt_wait(message.from_user.id)
     await message.answer(
         "Здравствуйте.\n\n"
         "🤖 Служба поддержки\n"
@@ -330,26 +1329,29 @@ async def start(message: Message, state: FSMContext):
         reply_markup=kb_start()
     )
 
-@router.callback_query(F.data == "u:home")
+@callback_action("u:home", "uh")
 async def home(call: CallbackQuery, state: FSMContext):
     await state.clear()
+    forget_receipt_wait(call.from_user.id)
     await call.message.edit_text(
         "🏠 Главное меню\n\nНажмите «➕ Создать обращение».",
         reply_markup=kb_start()
     )
     await call.answer()
 
-@router.callback_query(F.data == "u:new")
+@callback_action("u:new", "un")
 async def new_ticket(call: CallbackQuery, state: FSMContext):
     await state.clear()
+    forget_receipt_wait(call.from_user.id)
     await state.set_state(Flow.choosing_category)
     await call.message.edit_text("📌 Выберите категорию обращения:", reply_markup=kb_categories())
     await call.answer()
 
-@router.callback_query(Flow.choosing_category, F.data.startswith("u:cat:"))
-async def pick_category(call: CallbackQuery, state: FSMContext):
-    cat = call.data.split(":")[-1]
-    if cat not in CAT_TITLE:
+@callback_action("u:cat", "uc", Flow.choosing_category, arg=str)
+async def pick_category(call: CallbackQuery, state: FSMContext, arg: str):
+    cat = arg
+    catalog = get_catalog()
+    if cat not in catalog.cat_title:
         await call.answer("Неизвестная категория", show_alert=True)
         return
 
@@ -371,36 +1373,43 @@ async def pick_category(call: CallbackQuery, state: FSMContext):
     await state.set_state(Flow.collecting)
 
     await call.message.edit_text(
-        f"✅ Категория: {CAT_TITLE[cat]}\n\n"
+        f"✅ Категория: {catalog.cat_title[cat]}\n\n"
         "✍️ Отправьте описание одним сообщением.\n"
-        "📎 При необходимости можете сразу отправлять скриншот/видео/файл (до 5 вложений).\n\n"
+        f"📎 При необходимости можете сразу отправлять скриншот/видео/файл (до {catalog.max_attachments} вложений).\n\n"
         "Далее будет подтверждение перед отправкой.",
         reply_markup=kb_collecting()
     )
     await call.answer()
 
-@router.callback_query(F.data == "u:back_cat")
+@callback_action("u:back_cat", "ub")
 async def back_to_categories(call: CallbackQuery, state: FSMContext):
+    forget_receipt_wait(call.from_user.id)
     await state.clear()
     await state.set_state(Flow.choosing_category)
     await call.message.edit_text("📌 Выберите категорию обращения:", reply_markup=kb_categories())
     await call.answer()
 
 # -------------------- ОПЛАТА РФ (QR) — ДОБАВЛЕНО --------------------
-@router.callback_query(Flow.payment_plan, F.data.startswith("u:payplan:"))
-async def payment_pick_plan(call: CallbackQuery, state: FSMContext, bot: Bot):
-    plan_key = call.data.split(":")[-1]
-    if plan_key not in PLAN_TITLE:
+@callback_action("u:payplan", "up", Flow.payment_plan, arg=str)
+async def payment_pick_plan(call: CallbackQuery, state: FSMContext, bot: Bot, arg: str):
+    plan_key = arg
+    catalog = get_catalog()
+    if plan_key not in catalog.plan_title:
         await call.answer("Неизвестный период", show_alert=True)
         return
 
-    # сохраняем период и сумму, дальше просим email
-    await state.update_data(payment_plan=plan_key, payment_price=PLAN_PRICE.get(plan_key), payment_email=None)
+    # сохраняем период, сумму и QR на момент выбора (конфиг могут перезагрузить), дальше просим email
+    title = catalog.plan_title[plan_key]
+    price = catalog.plan_price[plan_key]
+    await state.update_data(
+        payment_plan=plan_key,
+        payment_plan_title=title,
+        payment_price=price,
+        payment_qr=catalog.qr_files.get(plan_key),
+        payment_email=None,
+    )
     await state.set_state(Flow.payment_email)
 
-    title = PLAN_TITLE[plan_key]
-    price = PLAN_PRICE[plan_key]
-
     await call.answer()
     await call.message.answer(
         "💳 Оплата РФ (QR)\n\n"
@@ -437,7 +1446,7 @@ async def payment_email_any(message: Message, state: FSMContext):
         reply_markup=kb_payment_confirm()
     )
 
-@router.callback_query(Flow.payment_confirm, F.data == "u:pay_change_email")
+@callback_action("u:pay_change_email", "ue", Flow.payment_confirm)
 async def pay_change_email(call: CallbackQuery, state: FSMContext):
     await state.set_state(Flow.payment_email)
     await call.answer()
@@ -447,7 +1456,7 @@ async def pay_change_email(call: CallbackQuery, state: FSMContext):
         reply_markup=kb_payment_help()
     )
 
-@router.callback_query(Flow.payment_confirm, F.data == "u:pay_change_plan")
+@callback_action("u:pay_change_plan", "ui", Flow.payment_confirm)
 async def pay_change_plan(call: CallbackQuery, state: FSMContext):
     await state.set_state(Flow.payment_plan)
     await call.answer()
@@ -456,19 +1465,18 @@ async def pay_change_plan(call: CallbackQuery, state: FSMContext):
         reply_markup=kb_payment_plans()
     )
 
-@router.callback_query(Flow.payment_confirm, F.data == "u:pay_confirm_ok")
+@callback_action("u:pay_confirm_ok", "uo", Flow.payment_confirm)
 async def pay_confirm_ok(call: CallbackQuery, state: FSMContext):
     data = await state.get_data()
-    plan_key = data.get("payment_plan")
     email = data.get("payment_email")
-    if not plan_key or plan_key not in PLAN_TITLE or not email or not is_valid_email(email):
+    if not data.get("payment_price") or not email or not is_valid_email(email):
         await call.answer("Не хватает данных. Проверьте период и email.", show_alert=True)
         return
 
-    title = PLAN_TITLE[plan_key]
-    price = PLAN_PRICE[plan_key]
+    title = data["payment_plan_title"]
+    price = data["payment_price"]
 
-    qr_file = safe_qr_inputfile(plan_key)
+    qr_file = safe_qr_inputfile(data.get("payment_qr"))
     text = (
         f"💳 Оплата РФ (QR)\n\n"
         f"📆 Период: {title}\n"
@@ -480,27 +1488,32 @@ async def pay_confirm_ok(call: CallbackQuery, state: FSMContext):
     )
 
     await state.set_state(Flow.payment_wait_receipt)
+    remind_after = get_settings().receipt_remind_after
+    if remind_after > 0:
+        RECEIPT_WAITS[call.from_user.id] = {k: data.get(k) for k in RECEIPT_WAIT_KEYS}
+        TIMERS.schedule("receipt", call.from_user.id, time.time() + remind_after)
     await call.answer()
 
     if qr_file:
         await call.message.answer_photo(qr_file, caption=text, reply_markup=kb_payment_help())
     else:
-        await call.message.answer(text + "\n\n⚠️ QR не найден в файлах проекта. Проверьте пути QR_FILES.", reply_markup=kb_payment_help())
+        await call.message.answer(text + "\n\n⚠️ QR не найден в файлах проекта. Проверьте qr_file в config.json.", reply_markup=kb_payment_help())
 
-@router.callback_query(Flow.payment_wait_receipt, F.data == "u:pay_contact_admin")
+@callback_action("u:pay_contact_admin", "ua", Flow.payment_wait_receipt)
 async def payment_contact_admin(call: CallbackQuery, state: FSMContext, bot: Bot):
     data = await state.get_data()
-    plan_key = data.get("payment_plan")
-    title = PLAN_TITLE.get(plan_key or "", "—")
-    price = PLAN_PRICE.get(plan_key or "", "—")
+    title = data.get("payment_plan_title") or "—"
+    price = data.get("payment_price") or "—"
     email = data.get("payment_email") or "—"
 
     u = call.from_user
     uname = f"@{u.username}" if u.username else "нет"
     link = f"tg://user?id={u.id}"
 
+    dest = primary_destination("PAYMENT_RU")
     await bot.send_message(
-        chat_id=SUPPORT_CHAT_ID,
+        chat_id=dest.chat_id,
+        message_thread_id=dest.thread_id,
         text=(
             "🚨 Запрос связи с админом (оплата РФ)\n\n"
             f"👤 Пользователь: {u.full_name or 'Пользователь'}\n"
@@ -533,7 +1546,7 @@ async def payment_wait_receipt_any(message: Message, state: FSMContext, bot: Bot
     data = await state.get_data()
     plan_key = data.get("payment_plan")
     email = data.get("payment_email")
-    if not plan_key or plan_key not in PLAN_TITLE or not email or not is_valid_email(email):
+    if not plan_key or not data.get("payment_price") or not email or not is_valid_email(email):
         await message.answer(
             "⚠️ Не хватает данных (период/email). Нажмите «🏠 В начало» и начните заново.",
             reply_markup=kb_payment_help()
@@ -556,42 +1569,20 @@ async def payment_wait_receipt_any(message: Message, state: FSMContext, bot: Bot
         created_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
         group_message_id=None,
         payment_plan=plan_key,
-        payment_price_rub=PLAN_PRICE.get(plan_key),
+        payment_plan_title=data.get("payment_plan_title"),
+        payment_price_rub=data.get("payment_price"),
         subscription_added=False,
         payment_email=email,
     )
-    tickets[t.ticket_id] = t
-
-    # карточка в группу
-    sent = await bot.send_message(
-        chat_id=SUPPORT_CHAT_ID,
-        text=render_ticket_text(t),
-        reply_markup=kb_admin_payment(t.ticket_id)
-    )
-    t.group_message_id = sent.message_id
+    register_ticket(t)
+    auto_assign(t)
 
-    # сам чек в группу реплаем
-    try:
-        cap = "🧾 Чек/скрин оплаты"
-        if att.kind == "photo":
-            await bot.send_photo(SUPPORT_CHAT_ID, att.file_id, caption=cap, reply_to_message_id=sent.message_id)
-        elif att.kind == "video":
-            await bot.send_video(SUPPORT_CHAT_ID, att.file_id, caption=cap, reply_to_message_id=sent.message_id)
-        elif att.kind == "document":
-            await bot.send_document(SUPPORT_CHAT_ID, att.file_id, caption=cap, reply_to_message_id=sent.message_id)
-        elif att.kind == "video_note":
-            await bot.send_video_note(SUPPORT_CHAT_ID, att.file_id, reply_to_message_id=sent.message_id)
-        elif att.kind == "voice":
-            await bot.send_voice(SUPPORT_CHAT_ID, att.file_id, caption=cap, reply_to_message_id=sent.message_id)
-        elif att.kind == "audio":
-            await bot.send_audio(SUPPORT_CHAT_ID, att.file_id, caption=cap, reply_to_message_id=sent.message_id)
-        else:
-            await bot.send_message(SUPPORT_CHAT_ID, f"⚠️ Неизвестный тип вложения: {att.kind}", reply_to_message_id=sent.message_id)
-    except Exception:
-        await bot.send_message(SUPPORT_CHAT_ID, f"⚠️ Не удалось отправить чек к обращению #{t.ticket_id}.")
+    # карточка в группы категории, чек — реплаем
+    await post_ticket(bot, t, receipt=True)
 
     # ответ пользователю
     await state.clear()
+    forget_receipt_wait(u.id)
     await message.answer(
         "✅ Платёжные данные получены.\n"
         "Мы проверим оплату и свяжемся с вами в ближайшее время.",
@@ -608,7 +1599,7 @@ async def collecting_any(message: Message, state: FSMContext):
     if att:
         ok = await add_att(state, att)
         if not ok:
-            await message.answer(f"⚠️ Можно прикрепить не более {MAX_ATTACHMENTS} файлов.")
+            await message.answer(f"⚠️ Можно прикрепить не более {get_catalog().max_attachments} файлов.")
             return
 
         data = await state.get_data()
@@ -629,16 +1620,16 @@ async def collecting_any(message: Message, state: FSMContext):
 
     await message.answer("Пожалуйста, отправьте текст описания или вложение (скрин/видео/файл).")
 
-@router.callback_query(Flow.confirming, F.data == "u:add_file_tip")
+@callback_action("u:add_file_tip", "uf", Flow.confirming)
 async def add_file_tip(call: CallbackQuery):
     await call.answer()
     await call.message.answer("📎 Пришлите файл (скриншот/видео/документ). Затем вернёмся к подтверждению.")
 
-@router.callback_query(Flow.confirming, F.data == "u:edit_text")
+@callback_action("u:edit_text", "ut", Flow.confirming)
 async def edit_text(call: CallbackQuery, state: FSMContext):
     await state.set_state(Flow.collecting)
     data = await state.get_data()
-    cat = CAT_TITLE.get(data.get("category"), "—")
+    cat = get_catalog().cat_title.get(data.get("category"), "—")
     await call.message.answer(
         f"✍️ Изменение текста\n\nКатегория: {cat}\n"
         "Отправьте новый текст описания. (Вложения сохранятся.)",
@@ -652,7 +1643,7 @@ async def confirming_any(message: Message, state: FSMContext):
     if att:
         ok = await add_att(state, att)
         if not ok:
-            await message.answer(f"⚠️ Можно прикрепить не более {MAX_ATTACHMENTS} файлов.")
+            await message.answer(f"⚠️ Можно прикрепить не более {get_catalog().max_attachments} файлов.")
             return
         data = await state.get_data()
         await message.answer("📎 Вложение добавлено.")
@@ -668,7 +1659,7 @@ async def confirming_any(message: Message, state: FSMContext):
 
     await message.answer("Отправьте текст или вложение, либо нажмите кнопку на экране подтверждения.")
 
-@router.callback_query(Flow.confirming, F.data == "u:send")
+@callback_action("u:send", "us", Flow.confirming)
 async def send_ticket(call: CallbackQuery, state: FSMContext, bot: Bot):
     global ticket_counter
 
@@ -696,81 +1687,196 @@ async def send_ticket(call: CallbackQuery, state: FSMContext, bot: Bot):
         created_at=datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
         group_message_id=None
     )
-    tickets[t.ticket_id] = t
-
-    sent = await bot.send_message(
-        chat_id=SUPPORT_CHAT_ID,
-        text=render_ticket_text(t),
-        reply_markup=kb_admin(t.ticket_id)
-    )
-    t.group_message_id = sent.message_id
+    register_ticket(t)
+    auto_assign(t)
 
-    for a in t.attachments:
-        cap = a.caption or ""
-        try:
-            if a.kind == "photo":
-                await bot.send_photo(SUPPORT_CHAT_ID, a.file_id, caption=cap or None, reply_to_message_id=sent.message_id)
-            elif a.kind == "video":
-                await bot.send_video(SUPPORT_CHAT_ID, a.file_id, caption=cap or None, reply_to_message_id=sent.message_id)
-            elif a.kind == "document":
-                await bot.send_document(SUPPORT_CHAT_ID, a.file_id, caption=cap or None, reply_to_message_id=sent.message_id)
-            elif a.kind == "video_note":
-                await bot.send_video_note(SUPPORT_CHAT_ID, a.file_id, reply_to_message_id=sent.message_id)
-            elif a.kind == "voice":
-                await bot.send_voice(SUPPORT_CHAT_ID, a.file_id, caption=cap or None, reply_to_message_id=sent.message_id)
-            elif a.kind == "audio":
-                await bot.send_audio(SUPPORT_CHAT_ID, a.file_id, caption=cap or None, reply_to_message_id=sent.message_id)
-        except Exception:
-            await bot.send_message(SUPPORT_CHAT_ID, f"⚠️ Не удалось отправить вложение к обращению #{t.ticket_id} (тип: {a.kind}).")
+    await post_ticket(bot, t)
 
     await state.clear()
     await call.message.edit_text(
         "✅ Обращение принято.\n"
-        "Мы свяжемся с вами в ближайшее время.",
+        "Мы свяжемся с вами в ближайшее время.\n\n"
+        "Чтобы что-то добавить — просто напишите сюда, мы передадим это в обращение.",
         reply_markup=kb_after_user()
     )
     await call.answer()
 
-# -------------------- Админ (кнопки в группе) --------------------
-async def update_group_card(bot: Bot, t: Ticket):
-    if not t.group_message_id:
+# -------------------- Дополнения к открытому обращению --------------------
+@dataclass
+class FollowupBatch:
+    ticket_id: int
+    texts: List[str] = field(default_factory=list)
+    attachments: List[Attachment] = field(default_factory=list)
+    task: Optional[asyncio.Task] = None
+
+# user_id -> сообщения, ждущие отправки в группу
+FOLLOWUPS: Dict[int, FollowupBatch] = {}
+
+def latest_open_ticket(user_id: int) -> Optional[Ticket]:
+    open_ids = USER_TICKETS.get(user_id)
+    return tickets.get(open_ids[-1]) if open_ids else None
+
+# После send_ticket состояние очищено: сюда попадает всё, что пользователь пишет вне сценария
+@router.message(StateFilter(None), F.chat.type == "private")
+async def followup_any(message: Message, bot: Bot):
+    user_id = message.from_user.id
+    t = latest_open_ticket(user_id)
+    if not t:
+        await message.answer(
+            "Открытых обращений нет.\nНажмите «➕ Создать обращение», чтобы написать в поддержку.",
+            reply_markup=kb_start()
+        )
         return
-    try:
-        # Для оплаты РФ — другая клавиатура
-        markup = kb_admin_payment(t.ticket_id) if t.category == "PAYMENT_RU" else kb_admin(t.ticket_id)
-        await bot.edit_message_text(
-            chat_id=SUPPORT_CHAT_ID,
-            message_id=t.group_message_id,
-            text=render_ticket_text(t),
-            reply_markup=markup
+
+    att = extract_attachment(message)
+    text = (message.text or "").strip()
+    if not att and (not text or text.startswith("/")):
+        await message.answer(
+            f"Отправьте текст или файл — мы добавим его к обращению #{t.ticket_id}.",
+            reply_markup=kb_after_user()
         )
+        return
+
+    batch = FOLLOWUPS.get(user_id)
+    if batch and batch.ticket_id != t.ticket_id:
+        await flush_followup(bot, user_id)
+        batch = None
+    if batch is None:
+        batch = FollowupBatch(ticket_id=t.ticket_id)
+        FOLLOWUPS[user_id] = batch
+        batch.task = asyncio.create_task(flush_followup_later(bot, user_id, batch))
+
+    if att:
+        batch.attachments.append(att)
+    else:
+        batch.texts.append(text)
+
+async def flush_followup_later(bot: Bot, user_id: int, batch: FollowupBatch):
+    await asyncio.sleep(get_settings().followup_batch_delay)
+    if FOLLOWUPS.get(user_id) is batch:
+        await flush_followup(bot, user_id)
+
+async def flush_followup(bot: Bot, user_id: int):
+    batch = FOLLOWUPS.pop(user_id, None)
+    if batch is None:
+        return
+    if batch.task is not None and batch.task is not asyncio.current_task():
+        batch.task.cancel()
+
+    t = tickets.get(batch.ticket_id)
+    if not t or t.status == "closed":
+        try:
+            await bot.send_message(
+                user_id,
+                f"Обращение #{batch.ticket_id} уже закрыто, сообщение не передано.\n"
+                "Если нужна помощь — создайте новое обращение.",
+                reply_markup=kb_start()
+            )
+        except Exception:
+            pass
+        return
+
+    # реплай под карточкой; если карточка ещё отправляется — просто в основную группу
+    card = primary_card(t)
+    if card:
+        chat_id, thread_id, reply_to = card.chat_id, card.thread_id, card.message_id
+    else:
+        dest = primary_destination(t.category)
+        chat_id, thread_id, reply_to = dest.chat_id, dest.thread_id, None
+
+    header = f"➕ Дополнение к обращению #{t.ticket_id}\n👤 {t.full_name} (ID {t.user_id})"
+    body = header + "".join(f"\n\n💬 {text}" for text in batch.texts)
+    # одно сообщение на пачку: текст идёт подписью к первому вложению (альбому), если влезает
+    posts = group_attachments(batch.attachments)
+    label = body
+    try:
+        first = posts[0][0] if posts else None
+        if first is None or len(body) + len(first.caption) + 2 > CAPTION_MAX:
+            await bot.send_message(
+                chat_id,
+                body,
+                message_thread_id=thread_id,
+                reply_to_message_id=reply_to
+            )
+            label = f"➕ К обращению #{t.ticket_id}"
+        for post in posts:
+            captions = [a.caption or None for a in post]
+            captions[0] = "\n\n".join(filter(None, (label, post[0].caption)))[:CAPTION_MAX]
+            label = f"➕ К обращению #{t.ticket_id}"
+            try:
+                await send_attachment_post(
+                    bot, chat_id, post, captions,
+                    message_thread_id=thread_id, reply_to_message_id=reply_to
+                )
+            except Exception:
+                kinds = ", ".join(a.kind for a in post)
+                await bot.send_message(
+                    chat_id,
+                    f"⚠️ Не удалось отправить вложения ({kinds}) к обращению #{t.ticket_id}.",
+                    message_thread_id=thread_id
+                )
+    except Exception:
+        logger.exception("Не удалось передать дополнение к обращению #%s", t.ticket_id)
+        return
+
+    touch_ticket(t)
+    try:
+        await bot.send_message(user_id, f"📝 Добавлено к обращению #{t.ticket_id}.")
     except Exception:
         pass
 
-@router.callback_query(F.data.startswith("a:work:"))
-async def admin_work(call: CallbackQuery, bot: Bot):
-    tid = int(call.data.split(":")[-1])
+async def flush_all_followups(bot: Bot):
+    await asyncio.gather(*(flush_followup(bot, uid) for uid in list(FOLLOWUPS)), return_exceptions=True)
+
+# -------------------- Админ (кнопки в группе) --------------------
+async def update_group_card(bot: Bot, t: Ticket):
+    text = render_ticket_text(t)
+    for card in t.cards:
+        try:
+            await bot.edit_message_text(
+                chat_id=card.chat_id,
+                message_id=card.message_id,
+                text=text,
+                reply_markup=kb_for_card(t, card)
+            )
+        except Exception:
+            pass
+
+@callback_action("a:work", "aw", arg=int)
+async def admin_work(call: CallbackQuery, bot: Bot, arg: int):
+    tid = arg
     t = tickets.get(tid)
-    if not t:
+    # кнопка должна быть нажата в одной из групп, где есть карточка тикета
+    if not t or not ticket_in_chat(t, call.message.chat.id):
         await call.answer("Тикет не найден", show_alert=True)
         return
     if t.status == "closed":
         await call.answer("Тикет уже закрыт", show_alert=True)
         return
 
-    t.status = "in_work"
+    set_status(t, "in_work")
+    prev = acknowledge(t, call.from_user)
     await update_group_card(bot, t)
-    await call.answer("Статус: В работе")
+    if prev is not None:
+        await call.answer(f"Статус: В работе (перехвачено у {admin_label(prev)})")
+    else:
+        await call.answer("Статус: В работе")
 
-@router.callback_query(F.data.startswith("a:close:"))
-async def admin_close(call: CallbackQuery, bot: Bot):
-    tid = int(call.data.split(":")[-1])
+@callback_action("a:close", "ac", arg=int)
+async def admin_close(call: CallbackQuery, bot: Bot, arg: int):
+    tid = arg
     t = tickets.get(tid)
-    if not t:
+    # кнопка должна быть нажата в одной из групп, где есть карточка тикета
+    if not t or not ticket_in_chat(t, call.message.chat.id):
         await call.answer("Тикет не найден", show_alert=True)
         return
 
-    t.status = "closed"
+    await close_ticket(bot, t)
+    await call.answer("Закрыто")
+
+# Общий путь закрытия: кнопка «✅ Закрыть» и автозакрытие по таймеру
+async def close_ticket(bot: Bot, t: Ticket, reason: Optional[str] = None):
+    set_status(t, "closed")
     await update_group_card(bot, t)
 
     # Сообщение пользователю — деловое
@@ -778,7 +1884,7 @@ async def admin_close(call: CallbackQuery, bot: Bot):
         await bot.send_message(
             chat_id=t.user_id,
             text=(
-                "✅ Обращение закрыто.\n"
+                f"✅ Обращение закрыто{': ' + reason if reason else ''}.\n"
                 "Если потребуется помощь — создайте новое обращение."
             ),
             reply_markup=kb_after_user()
@@ -786,27 +1892,26 @@ async def admin_close(call: CallbackQuery, bot: Bot):
     except Exception:
         pass
 
-    await call.answer("Закрыто")
-
 # ДОБАВЛЕНО: админ подтверждает, что подписка добавлена (для оплаты РФ)
-@router.callback_query(F.data.startswith("a:sub_added:"))
-async def admin_subscription_added(call: CallbackQuery, bot: Bot):
-    tid = int(call.data.split(":")[-1])
+@callback_action("a:sub_added", "as", arg=int)
+async def admin_subscription_added(call: CallbackQuery, bot: Bot, arg: int):
+    tid = arg
     t = tickets.get(tid)
-    if not t:
+    # кнопка должна быть нажата в одной из групп, где есть карточка тикета
+    if not t or not ticket_in_chat(t, call.message.chat.id):
         await call.answer("Тикет не найден", show_alert=True)
         return
     if t.category != "PAYMENT_RU":
         await call.answer("Это не тикет оплаты РФ", show_alert=True)
         return
 
-    t.subscription_added = True
-    t.status = "closed"
+    mark_subscription_added(t)
+    set_status(t, "closed")
     await update_group_card(bot, t)
 
     # уведомляем пользователя
     try:
-        plan = PLAN_TITLE.get(t.payment_plan or "", "подписка")
+        plan = t.payment_plan_title or get_catalog().plan_title.get(t.payment_plan or "", "подписка")
         await bot.send_message(
             chat_id=t.user_id,
             text=(
@@ -821,35 +1926,108 @@ async def admin_subscription_added(call: CallbackQuery, bot: Bot):
 
     await call.answer("Отмечено: подписка добавлена")
 
-@router.callback_query(F.data.startswith("a:reply:"))
-async def admin_reply(call: CallbackQuery):
-    tid = int(call.data.split(":")[-1])
+@callback_action("a:reply", "ar", arg=int)
+async def admin_reply(call: CallbackQuery, arg: int):
+    tid = arg
     t = tickets.get(tid)
-    if not t:
+    # кнопка должна быть нажата в одной из групп, где есть карточка тикета
+    if not t or not ticket_in_chat(t, call.message.chat.id):
         await call.answer("Тикет не найден", show_alert=True)
         return
     if t.status == "closed":
         await call.answer("Тикет закрыт. Ответить нельзя.", show_alert=True)
         return
+    # защита от двойных ответов: подтверждённый тикет ведёт только исполнитель
+    if t.acknowledged and t.assignee_id not in (None, call.from_user.id):
+        await call.answer(
+            f"Обращение ведёт {admin_label(t.assignee_id)}. "
+            "Чтобы забрать его, нажмите «🟡 В работе».",
+            show_alert=True
+        )
+        return
 
-    REPLY_MODE[call.from_user.id] = tid
+    REPLY_MODE[(call.message.chat.id, call.from_user.id)] = tid
     await call.answer()
     await call.message.reply(
         f"✉️ Ответ пользователю по обращению #{tid}\n"
         "Отправьте следующим сообщением текст или файл (фото/видео/документ)."
     )
 
+# ДОБАВЛЕНО: доступность админов для автоназначения
+@router.message(is_support_chat, Command("online"))
+async def admin_online(message: Message, bot: Bot):
+    a = ensure_admin(message.from_user)
+    a.online = True
+    await message.reply("🟢 Вы онлайн, новые обращения будут назначаться на вас.\n\n" + admins_status_text())
+    await assign_backlog(bot)
+
+@router.message(is_support_chat, Command("offline"))
+async def admin_offline(message: Message, bot: Bot):
+    a = ensure_admin(message.from_user)
+    a.online = False
+    await message.reply("⚪️ Вы офлайн.\n\n" + admins_status_text())
+    # неподтверждённые тикеты сразу отдаём другим
+    for tid in list(a.open_tickets):
+        t = tickets.get(tid)
+        if t and not t.acknowledged and t.status != "closed":
+            await reassign_unacknowledged(bot, t)
+
+async def is_chat_admin(bot: Bot, message: Message) -> bool:
+    member = await bot.get_chat_member(message.chat.id, message.from_user.id)
+    return member.status in ("creator", "administrator")
+
+# ДОБАВЛЕНО: перечитать config.json без перезапуска (только админы группы)
+@router.message(is_support_chat, Command("reload"))
+async def admin_reload(message: Message, bot: Bot):
+    if not await is_chat_admin(bot, message):
+        await message.reply("⛔️ Команда доступна только администраторам группы.")
+        return
+    ok, text = reload_catalog()
+    await message.reply(text)
+
+# ДОБАВЛЕНО: профилирование живого процесса (только админы группы)
+@router.message(is_support_chat, Command("profile"))
+async def admin_profile(message: Message, bot: Bot):
+    if not await is_chat_admin(bot, message):
+        await message.reply("⛔️ Профилирование доступно только администраторам группы.")
+        return
+
+    arg = (message.text or "").split(maxsplit=1)[1:]
+    if arg and arg[0].strip() == "stop":
+        if PROFILE is None:
+            await message.reply("Профилирование не запущено.")
+        else:
+            PROFILE.done.set()
+            await message.reply("⏹ Останавливаю, сводка придёт следующим сообщением.")
+        return
+
+    try:
+        seconds = float(arg[0]) if arg else PROFILE_DEFAULT_SECONDS
+        if not math.isfinite(seconds):
+            raise ValueError(arg[0])
+    except ValueError:
+        await message.reply("Использование: /profile [секунд] или /profile stop")
+        return
+
+    session = start_profile(bot, seconds, (message.chat.id, message.message_thread_id))
+    if session is None:
+        await message.reply("Профилирование уже идёт. Остановить: /profile stop")
+        return
+    await message.reply(f"▶️ Профилирование на {session.seconds:.0f} с. Сводка придёт сюда.")
+
 # Ловим сообщения в группе и отправляем пользователю, если админ в режиме ответа
-@router.message(F.chat.id == SUPPORT_CHAT_ID)
+# (режим ответа привязан к группе, где нажали «✉️ Ответить»)
+@router.message(is_support_chat)
 async def group_messages(message: Message, bot: Bot):
     admin_id = message.from_user.id
-    if admin_id not in REPLY_MODE:
+    key = (message.chat.id, admin_id)
+    if key not in REPLY_MODE:
         return
 
-    tid = REPLY_MODE.get(admin_id)
+    tid = REPLY_MODE.get(key)
     t = tickets.get(tid)
     if not t:
-        REPLY_MODE.pop(admin_id, None)
+        REPLY_MODE.pop(key, None)
         await message.reply("⚠️ Тикет не найден. Режим ответа сброшен.")
         return
 
@@ -884,22 +2062,733 @@ async def group_messages(message: Message, bot: Bot):
                 return
 
         await message.reply("✅ Ответ отправлен пользователю.")
-        REPLY_MODE.pop(admin_id, None)
+        REPLY_MODE.pop(key, None)
 
+        changed = not t.acknowledged or t.assignee_id != admin_id
+        if t.status == "closed":
+            changed = False
+        else:
+            acknowledge(t, message.from_user)
         if t.status == "new":
-            t.status = "in_work"
+            set_status(t, "in_work")
+            changed = True
+        else:
+            touch_ticket(t)
+        if changed:
             await update_group_card(bot, t)
 
     except Exception:
         await message.reply("⚠️ Не удалось отправить пользователю (возможно, он заблокировал бота).")
-        REPLY_MODE.pop(admin_id, None)
+        REPLY_MODE.pop(key, None)
+
+# -------------------- Таймеры обращений --------------------
+# Каждый таймер заново проверяет тикет/шаг пользователя: сработавший после смены статуса ничего не делает.
+async def on_ack_timeout(bot: Bot, ticket_id: int):
+    t = tickets.get(ticket_id)
+    if t and t.status != "closed" and not t.acknowledged:
+        await reassign_unacknowledged(bot, t)
+
+async def on_stale_ticket(bot: Bot, ticket_id: int):
+    t = tickets.get(ticket_id)
+    if not t or t.status != "in_work":
+        return
+    await close_ticket(bot, t, reason="нет новых сообщений")
+    card = primary_card(t)
+    if card:
+        try:
+            await bot.send_message(
+                card.chat_id,
+                f"⏱ Обращение #{t.ticket_id} закрыто автоматически: "
+                f"без сообщений {format_age(get_settings().stale_close_after)}.",
+                message_thread_id=card.thread_id,
+                reply_to_message_id=card.message_id,
+            )
+        except Exception:
+            pass
+
+async def on_sla_new(bot: Bot, ticket_id: int):
+    t = tickets.get(ticket_id)
+    if not t or t.status != "new":
+        return
+    TIMERS.schedule("sla", ticket_id, time.time() + get_settings().sla_new_after)
+    card = primary_card(t)
+    if not card:
+        return
+    created = datetime.strptime(t.created_at, "%Y-%m-%d %H:%M:%S")
+    age = (datetime.utcnow() - created).total_seconds()
+    who = admin_label(t.assignee_id) if t.assignee_id is not None else "исполнитель не назначен"
+    await bot.send_message(
+        card.chat_id,
+        f"⏰ Обращение #{t.ticket_id} ждёт {format_age(age)} и ещё не взято в работу ({who}).",
+        message_thread_id=card.thread_id,
+        reply_to_message_id=card.message_id,
+    )
+
+async def on_receipt_missing(bot: Bot, user_id: int):
+    data = RECEIPT_WAITS.pop(user_id, None)
+    if data is None or RUNTIME.storage is None:
+        return
+    key = StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id)
+    current = await RUNTIME.storage.get_state(key)
+    if current is None:
+        # бот перезапускался и FSM пуст: возвращаем пользователя на шаг чека из сохранённых данных
+        await RUNTIME.storage.set_state(key, Flow.payment_wait_receipt.state)
+        await RUNTIME.storage.set_data(key, data)
+    elif current != Flow.payment_wait_receipt.state:
+        return
+    await bot.send_message(
+        user_id,
+        "⏳ Мы всё ещё ждём чек об оплате.\n\n"
+        f"📆 Период: {data.get('payment_plan_title') or '—'}\n"
+        f"💵 Сумма: {data.get('payment_price') or '—'} ₽\n\n"
+        "Отправьте сюда чек/скрин оплаты (фото или файл). "
+        "Если возникли сложности — нажмите «👤 Связаться с админом».",
+        reply_markup=kb_payment_help()
+    )
+
+TIMER_HANDLERS: Dict[str, Callable[[Bot, int], Awaitable[None]]] = {
+    "ack": on_ack_timeout,
+    "stale": on_stale_ticket,
+    "sla": on_sla_new,
+    "receipt": on_receipt_missing,
+}
+
+async def timer_loop(bot: Bot):
+    # спим до ближайшего срока; более ранний таймер будит цикл через TIMERS.wakeup
+    while True:
+        TIMERS.wakeup.clear()
+        fired = TIMERS.pop_due(time.time())
+        for kind, key in fired:
+            try:
+                await TIMER_HANDLERS[kind](bot, key)
+            except Exception:
+                logger.exception("Таймер %s для %s завершился ошибкой", kind, key)
+        due = TIMERS.next_due()
+        try:
+            await asyncio.wait_for(TIMERS.wakeup.wait(), None if due is None else max(0.0, due - time.time()))
+        except asyncio.TimeoutError:
+            pass
+
+# -------------------- Сохранение состояния (STATE_FILE) --------------------
+# Сохраняются только изменения: тикет сериализуется (asdict) после того, как его пометили mark_dirty,
+# открытые лежат в SAVED_TICKETS до следующей правки, закрытые дописываются в журнал и из снимка уходят.
+# На event loop — только asdict изменённых тикетов; json и запись на диск — в отдельном потоке.
+# Так сохранение стоит O(изменённых + открытых), а не O(всех тикетов за всё время).
+STATE_VERSION = 2
+SAVED_TICKETS: Dict[int, Dict[str, Any]] = {}  # ticket_id -> последний снимок открытого тикета
+STATE_LOCK = asyncio.Lock()
+
+def closed_journal_path(path: str) -> str:
+    return f"{path}.closed.jsonl"
+
+def collect_dirty_tickets() -> List[Dict[str, Any]]:
+    closed: List[Dict[str, Any]] = []
+    for tid in DIRTY_TICKETS:
+        t = tickets.get(tid)
+        if t is None:
+            continue
+        if t.status == "closed":
+            SAVED_TICKETS.pop(tid, None)
+            closed.append(asdict(t))
+        else:
+            SAVED_TICKETS[tid] = asdict(t)
+    DIRTY_TICKETS.clear()
+    return closed
+
+def state_snapshot() -> Dict[str, Any]:
+    return {
+        "version": STATE_VERSION,
+        "saved_at": time.time(),
+        "ticket_counter": ticket_counter,
+        "tickets": list(SAVED_TICKETS.values()),
+        # online не сохраняем: после перезапуска админы заново отмечаются /online
+        "admins": [
+            {"admin_id": a.admin_id, "full_name": a.full_name, "username": a.username}
+            for a in ADMINS.values()
+        ],
+        "timers": TIMERS.snapshot(),
+        "receipt_waits": {str(uid): data for uid, data in RECEIPT_WAITS.items()},
+        "dashboard_message_id": DASHBOARD.message_id,
+    }
+
+def write_state(path: str, snapshot: Dict[str, Any], closed: List[Dict[str, Any]]):
+    # сначала журнал: при сбое между записями тикет останется открытым в старом снимке,
+    # а не пропадёт
+    if closed:
+        with open(closed_journal_path(path), "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(d, ensure_ascii=False) + "\n" for d in closed)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+async def save_state():
+    async with STATE_LOCK:
+        RUNTIME.state_dirty = False
+        TIMERS.dirty = False
+        closed = collect_dirty_tickets()
+        snapshot = state_snapshot()
+        try:
+            await asyncio.to_thread(write_state, get_settings().state_file, snapshot, closed)
+        except Exception:
+            # повторим при следующем сохранении (повтор строки в журнале безвреден: побеждает последняя)
+            DIRTY_TICKETS.update(d["ticket_id"] for d in closed)
+            RUNTIME.state_dirty = True
+            raise
+
+async def state_saver():
+    while True:
+        await asyncio.sleep(STATE_SAVE_INTERVAL)
+        if RUNTIME.state_dirty or TIMERS.dirty:
+            try:
+                await save_state()
+            except Exception:
+                logger.exception("Не удалось сохранить %s", get_settings().state_file)
+
+def read_closed_journal(path: str) -> Dict[int, Dict[str, Any]]:
+    closed: Dict[int, Dict[str, Any]] = {}
+    if not os.path.exists(path):
+        return closed
+    with open(path, encoding="utf-8") as f:
+        for n, line in enumerate(f, 1):
+            try:
+                d = json.loads(line)
+                closed[d["ticket_id"]] = d
+            except (ValueError, KeyError, TypeError):
+                # недописанная последняя строка после сбоя — пропускаем
+                logger.warning("%s:%s: пропущена повреждённая строка", path, n)
+    return closed
+
+def load_state(path: str) -> int:
+    global ticket_counter
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(path, encoding="utf-8") as f:
+            raw = json.load(f)
+    except (OSError, ValueError):
+        # битый файл не перезаписываем: откладываем в сторону и стартуем с пустого состояния
+        broken = f"{path}.broken-{int(time.time())}"
+        os.replace(path, broken)
+        logger.exception("Не удалось прочитать %s, файл перенесён в %s", path, broken)
+        return 0
+
+    for d in raw.get("admins", []):
+        d = {k: v for k, v in d.items() if k != "online"}
+        ADMINS[d["admin_id"]] = Admin(**d)
+    # закрытые — из журнала, открытые — из снимка (снимок новее: тикет могли открыть заново)
+    rows = read_closed_journal(closed_journal_path(path))
+    rows.update((d["ticket_id"], d) for d in raw.get("tickets", []))
+    for tid in sorted(rows):
+        d = dict(rows[tid])
+        d["attachments"] = [Attachment(**a) for a in d.get("attachments", [])]
+        d["cards"] = [Card(**c) for c in d.get("cards", [])]
+        t = Ticket(**d)
+        register_ticket(t)
+        if t.status == "closed":
+            continue
+        SAVED_TICKETS[tid] = rows[tid]
+        if t.assignee_id is None:
+            UNASSIGNED[t.ticket_id] = None
+        elif t.assignee_id in ADMINS:
+            ADMINS[t.assignee_id].open_tickets.add(t.ticket_id)
+    ticket_counter = max(raw.get("ticket_counter", 0), max(tickets, default=0))
+    # сроки — из снимка (register_ticket выше поставил бы их заново от текущего времени)
+    TIMERS.restore(raw.get("timers", []))
+    RECEIPT_WAITS.update({int(uid): data for uid, data in raw.get("receipt_waits", {}).items()})
+    DASHBOARD.message_id = raw.get("dashboard_message_id")
+    if raw.get("version", 1) < STATE_VERSION:
+        # старый снимок со всеми тикетами: закрытые переедут в журнал при первом сохранении
+        DIRTY_TICKETS.clear()
+        DIRTY_TICKETS.update(tid for tid, t in tickets.items() if t.status == "closed")
+        RUNTIME.state_dirty = True
+    else:
+        DIRTY_TICKETS.clear()
+        RUNTIME.state_dirty = False
+    return len(tickets)
+
+# -------------------- Профилирование --------------------
+# Пока сессии нет, ничего не работает: нет потока-сэмплера, в middleware — одна проверка на None.
+@dataclass
+class ProfileSession:
+    seconds: float
+    started_at: float = field(default_factory=time.monotonic)
+    stacks: Counter = field(default_factory=Counter)
+    handler_times: Dict[str, List[float]] = field(default_factory=dict)
+    lag_samples: List[float] = field(default_factory=list)
+    max_tasks: int = 0
+    stop: threading.Event = field(default_factory=threading.Event)
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+    report_to: Optional[Tuple[int, Optional[int]]] = None  # (chat_id, thread_id)
+
+PROFILE: Optional[ProfileSession] = None
+
+def _sample_stacks(session: ProfileSession, thread_id: int):
+    # сэмплируем стек потока с event loop; idle-время видно как select/poll
+    while not session.stop.wait(PROFILE_SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            session.stacks[";".join(reversed(stack))] += 1
+
+async def profile_handlers(
+    handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+    event: Any,
+    data: Dict[str, Any],
+) -> Any:
+    session = PROFILE
+    if session is None:
+        return await handler(event, data)
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    finally:
+        h = data.get("handler")
+        name = h.callback.__name__ if h is not None else type(event).__name__
+        if isinstance(event, CallbackQuery):
+            # все кнопки идут через dispatch_callback — показываем конкретное действие
+            parsed = parse_callback(event.data or "")
+            if parsed:
+                name = parsed[0].handler.__name__
+        session.handler_times.setdefault(name, []).append(time.perf_counter() - started)
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+def profile_summary(session: ProfileSession) -> str:
+    total = sum(session.stacks.values())
+    lines = [
+        f"⏱ Профилирование: {time.monotonic() - session.started_at:.0f} с, сэмплов: {total}",
+    ]
+    if session.lag_samples:
+        lag = session.lag_samples
+        lines.append(
+            f"🔁 Задержка event loop: ср. {sum(lag) / len(lag) * 1000:.1f} мс, "
+            f"p99 {_percentile(lag, 0.99) * 1000:.1f} мс, макс. {max(lag) * 1000:.1f} мс"
+        )
+    lines.append(f"🧵 Задач asyncio (пик): {session.max_tasks}")
+
+    if session.handler_times:
+        lines.append("\nОбработчики (вызовов, ср./p95/макс., мс):")
+        ranked = sorted(session.handler_times.items(), key=lambda kv: sum(kv[1]), reverse=True)
+        for name, times in ranked[:10]:
+            lines.append(
+                f"• {name}: {len(times)}, {sum(times) / len(times) * 1000:.1f}/"
+                f"{_percentile(times, 0.95) * 1000:.1f}/{max(times) * 1000:.1f}"
+            )
+
+    # «горячие» функции бота: в скольких сэмплах функция была на стеке
+    own = os.path.basename(__file__)
+    inclusive: Counter = Counter()
+    for stack, n in session.stacks.items():
+        for frame in set(stack.split(";")):
+            if f"({own}:" in frame:
+                inclusive[frame] += n
+    if total and inclusive:
+        lines.append(f"\nГорячие функции {own} (% сэмплов):")
+        for frame, n in inclusive.most_common(10):
+            lines.append(f"• {frame}: {n * 100 / total:.1f}%")
+    return "\n".join(lines)
+
+def write_profile(session: ProfileSession) -> str:
+    directory = get_settings().profile_dir
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, "profile-" + datetime.utcnow().strftime("%Y%m%d-%H%M%S"))
+    with open(base + ".collapsed", "w", encoding="utf-8") as f:
+        for stack, n in session.stacks.most_common():
+            f.write(f"{stack} {n}\n")
+    with open(base + ".txt", "w", encoding="utf-8") as f:
+        f.write(profile_summary(session) + "\n")
+    return base
+
+def start_profile(bot: Bot, seconds: float, report_to: Optional[Tuple[int, Optional[int]]]) -> Optional[ProfileSession]:
+    global PROFILE
+    if PROFILE is not None:
+        return None
+    session = ProfileSession(seconds=min(max(seconds, 1), PROFILE_MAX_SECONDS), report_to=report_to)
+    PROFILE = session
+    sampler = threading.Thread(
+        target=_sample_stacks, args=(session, threading.get_ident()),
+        name="profile-sampler", daemon=True,
+    )
+    sampler.start()
+    RUNTIME.profile_task = asyncio.create_task(_run_profile(bot, session, sampler))
+    return session
+
+async def _run_profile(bot: Bot, session: ProfileSession, sampler: threading.Thread):
+    global PROFILE
+    try:
+        await asyncio.wait_for(session.done.wait(), session.seconds)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        session.stop.set()
+        PROFILE = None
+    await asyncio.to_thread(sampler.join)
+    base = await asyncio.to_thread(write_profile, session)
+    logger.info("Профиль записан: %s.collapsed", base)
+
+    if session.report_to:
+        chat_id, thread_id = session.report_to
+        try:
+            await bot.send_message(
+                chat_id,
+                profile_summary(session) + f"\n\n📁 {base}.collapsed",
+                message_thread_id=thread_id,
+            )
+        except Exception:
+            logger.warning("Не удалось отправить сводку профилирования")
+
+def toggle_profile_by_signal(bot: Bot):
+    if PROFILE is not None:
+        PROFILE.done.set()
+        return
+    settings = get_settings()
+    report_to = (settings.support_chat_id, None) if settings.profile_post_summary else None
+    start_profile(bot, PROFILE_DEFAULT_SECONDS, report_to)
+
+# -------------------- Запись трафика --------------------
+# Строка файла: {"t": секунды от начала сессии записи, "u": апдейт}; первая строка — заголовок.
+# Сессия = один запуск бота: при ротации t продолжает идти от того же начала, а в заголовке
+# каждого файла повторяется один и тот же "session".
+# Кнопки пишутся в разобранном виде ("cb": [имя, аргумент]), чтобы replay.py
+# пересобрал и подписал их своим токеном.
+RECORD_FORMAT = 2
+RECORD_NAME_KEYS = {
+    "first_name", "last_name", "username", "title", "phone_number", "email",
+    "sender_user_name", "author_signature", "vcard",
+    "address", "foursquare_id", "google_place_id",  # venue
+}
+RECORD_FILE_KEYS = {"file_id", "file_unique_id"}
+# имя файла (в чеках PAYMENT_RU там ФИО плательщика) хэшируем, расширение оставляем
+RECORD_FILE_EXT = re.compile(r"\.[A-Za-z0-9]{1,5}$")
+# координаты location/venue огрубляем до ~10 км
+RECORD_COORD_KEYS = {"latitude", "longitude"}
+RECORD_COORD_DIGITS = 1
+RECORD_ID_KEYS = {"id", "user_id", "chat_id"}
+# "id" — это пользователь или чат внутри этих ключей, а также в любом объекте User (есть is_bot)
+# или Chat (type из RECORD_CHAT_TYPES): new_chat_members, forward_origin.sender_user, via_bot и т.д.
+RECORD_PEER_KEYS = {"from", "from_user", "chat", "sender_chat", "user", "forward_from", "forward_from_chat"}
+RECORD_CHAT_TYPES = {"private", "group", "supergroup", "channel"}
+
+class UpdateRecorder:
+    def __init__(self, directory: str, salt: str, rotate_mb: int = 20, keep_files: int = 50):
+        self.directory = directory
+        self.salt = salt.encode()
+        self.rotate_bytes = rotate_mb * 1024 * 1024
+        self.keep_files = keep_files
+        self.started = time.monotonic()
+        self.session = base64.urlsafe_b64encode(os.urandom(9)).decode()
+        self.session_started_utc = datetime.utcnow().isoformat(timespec="seconds")
+        self.lines: "queue.SimpleQueue[Optional[str]]" = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._write_loop, name="update-recorder", daemon=True)
+        os.makedirs(directory, exist_ok=True)
+        self.writer.start()
+
+    async def __call__(self, handler, event: Update, data: Dict[str, Any]) -> Any:
+        try:
+            self.lines.put(json.dumps(
+                {"t": round(time.monotonic() - self.started, 3), "u": self.anonymize_update(event)},
+                ensure_ascii=False,
+            ))
+        except Exception:
+            logger.exception("Не удалось записать апдейт %s", event.update_id)
+        return await handler(event, data)
+
+    def close(self):
+        self.lines.put(None)
+        self.writer.join(timeout=5)
+
+    # --- анонимизация ---
+    def _digest(self, value: Any) -> bytes:
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).digest()
+
+    def anon_id(self, value: int) -> int:
+        if value in get_settings().support_chats:
+            return value
+        n = int.from_bytes(self._digest(value)[:6], "big") or 1
+        return -n if value < 0 else n
+
+    def anon_text(self, text: str) -> str:
+        h = self._digest(text).hex()[:12]
+        if text.startswith("/"):
+            # команду сохраняем, аргументы — нет
+            return text.split(maxsplit=1)[0] + (f" {h}" if " " in text.strip() else "")
+        if is_valid_email(text):
+            return f"{h}@example.com"
+        return f"#{h}"
+
+    def anonymize(self, obj: Any, peer: bool = False) -> Any:
+        if isinstance(obj, list):
+            return [self.anonymize(v) for v in obj]
+        if not isinstance(obj, dict):
+            return obj
+        peer = peer or "is_bot" in obj or obj.get("type") in RECORD_CHAT_TYPES
+        out: Dict[str, Any] = {}
+        for key, value in obj.items():
+            if key in RECORD_PEER_KEYS:
+                out[key] = self.anonymize(value, peer=True)
+            elif key in RECORD_ID_KEYS and isinstance(value, int) and (peer or key != "id"):
+                out[key] = self.anon_id(value)
+            elif key in RECORD_NAME_KEYS and isinstance(value, str):
+                out[key] = "u" + self._digest(value).hex()[:10]
+            elif key in RECORD_FILE_KEYS and isinstance(value, str):
+                out[key] = self._digest(value).hex()[:24]
+            elif key == "file_name" and isinstance(value, str):
+                ext = RECORD_FILE_EXT.search(value)
+                out[key] = "f" + self._digest(value).hex()[:10] + (ext.group(0).lower() if ext else "")
+            elif key in RECORD_COORD_KEYS and isinstance(value, (int, float)):
+                out[key] = round(value, RECORD_COORD_DIGITS)
+            elif key == "horizontal_accuracy":
+                continue
+            elif key in ("text", "caption") and isinstance(value, str):
+                out[key] = self.anon_text(value)
+            elif key in ("entities", "caption_entities"):
+                # смещения сущностей относятся к исходному тексту; оставляем только команду в начале
+                kept = [e for e in value if e.get("type") == "bot_command" and e.get("offset") == 0]
+                if kept:
+                    out[key] = kept
+            elif key == "data" and isinstance(value, str):
+                parsed = parse_callback(value)
+                if parsed:
+                    out["cb"] = [parsed[0].name, parsed[1]]
+                else:
+                    out[key] = value
+            else:
+                out[key] = self.anonymize(value)
+        return out
+
+    def anonymize_update(self, update: Update) -> Dict[str, Any]:
+        return self.anonymize(update.model_dump(mode="json", exclude_none=True, by_alias=True))
+
+    # --- запись в фоне ---
+    def _open(self):
+        name = "updates-" + datetime.utcnow().strftime("%Y%m%d-%H%M%S-%f") + ".jsonl.gz"
+        f = gzip.open(os.path.join(self.directory, name), "wt", encoding="utf-8")
+        f.write(json.dumps({
+            "format": RECORD_FORMAT,
+            "session": self.session,
+            "session_started_utc": self.session_started_utc,
+            "started_utc": datetime.utcnow().isoformat(timespec="seconds"),
+            # ID групп поддержки не хэшируются; replay.py восстанавливает из них маршруты
+            "support_chat_id": get_settings().support_chat_id,
+            "support_routes": get_settings().routes_spec,
+        }) + "\n")
+        files = sorted(glob.glob(os.path.join(self.directory, "updates-*.jsonl.gz")))
+        for old in files[:-self.keep_files]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        return f
+
+    def _write_loop(self):
+        f = self._open()
+        written = 0
+        while True:
+            line = self.lines.get()
+            if line is None:
+                break
+            f.write(line + "\n")
+            written += len(line) + 1
+            if written >= self.rotate_bytes:
+                f.close()
+                f = self._open()
+                written = 0
+        f.close()
+
+RECORDER: Optional[UpdateRecorder] = None
+
+# -------------------- Жизненный цикл --------------------
+async def track_updates(
+    handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+    event: Update,
+    data: Dict[str, Any],
+) -> Any:
+    RUNTIME.last_update_at = time.monotonic()
+    RUNTIME.inflight += 1
+    RUNTIME.idle.clear()
+    try:
+        return await handler(event, data)
+    finally:
+        RUNTIME.inflight -= 1
+        if RUNTIME.inflight == 0:
+            RUNTIME.idle.set()
+
+async def loop_lag_monitor():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        RUNTIME.loop_lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+        session = PROFILE
+        if session is not None:
+            session.lag_samples.append(RUNTIME.loop_lag)
+            session.max_tasks = max(session.max_tasks, len(asyncio.all_tasks()))
+
+def health_payload() -> Dict[str, Any]:
+    age = None
+    if RUNTIME.last_update_at is not None:
+        age = round(time.monotonic() - RUNTIME.last_update_at, 1)
+    return {
+        "ready": RUNTIME.ready,
+        "draining": RUNTIME.draining,
+        "loop_lag_ms": round(RUNTIME.loop_lag * 1000, 1),
+        "last_update_age_s": age,
+        "inflight": RUNTIME.inflight,
+    }
+
+async def start_health_server(port: int):
+    # aiohttp ставится вместе с aiogram
+    from aiohttp import web
+
+    async def healthz(request):
+        ok = RUNTIME.loop_lag < get_settings().health_max_lag
+        return web.json_response(health_payload(), status=200 if ok else 503)
+
+    async def readyz(request):
+        ok = RUNTIME.ready and not RUNTIME.draining
+        return web.json_response(health_payload(), status=200 if ok else 503)
+
+    app = web.Application()
+    app.router.add_get("/healthz", healthz)
+    app.router.add_get("/readyz", readyz)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, port=port).start()
+    return runner
+
+async def on_startup(bot: Bot):
+    get_catalog()  # ошибки в config.json — сразу при старте
+    settings = get_settings()
+    if settings.state_file and not tickets:
+        restored = load_state(settings.state_file)
+        if restored:
+            logger.info("Восстановлено обращений: %s, таймеров: %s", restored, len(TIMERS.active))
+    RUNTIME.background = [
+        asyncio.create_task(timer_loop(bot)),
+        asyncio.create_task(loop_lag_monitor()),
+    ]
+    if settings.state_file:
+        RUNTIME.background.append(asyncio.create_task(state_saver()))
+    if settings.dashboard_interval > 0:
+        RUNTIME.background.append(asyncio.create_task(dashboard_loop(bot)))
+    if settings.config_watch_interval > 0:
+        RUNTIME.background.append(asyncio.create_task(watch_catalog(bot)))
+    if settings.health_port and RUNTIME.health_runner is None:
+        RUNTIME.health_runner = await start_health_server(settings.health_port)
+    if hasattr(signal, "SIGUSR2"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, toggle_profile_by_signal, bot)
+    RUNTIME.ready = True
+
+async def drain(bot: Bot, timeout: float):
+    # polling уже остановлен: новых апдейтов нет, ждём начатые обработчики
+    await asyncio.sleep(0)
+    try:
+        await asyncio.wait_for(RUNTIME.idle.wait(), timeout)
+        return
+    except asyncio.TimeoutError:
+        pass
+
+    logger.warning("Не дождались %s обработчик(ов) за %.0f с", RUNTIME.inflight, timeout)
+    # чекпоинт: помечаем тикеты, вложения которых могли не дойти
+    for tid in sorted(RUNTIME.posting):
+        t = tickets.get(tid)
+        card = primary_card(t) if t else None
+        if not card:
+            logger.warning("Обращение #%s не успели отправить в группу поддержки", tid)
+            continue
+        try:
+            await asyncio.wait_for(bot.send_message(
+                card.chat_id,
+                f"⚠️ Бот перезапускался во время отправки обращения #{tid}: "
+                "часть вложений могла не дойти.",
+                message_thread_id=card.thread_id,
+                reply_to_message_id=card.message_id,
+            ), 5)
+        except Exception:
+            logger.warning("Обращение #%s отправлено не полностью", tid)
+
+async def on_shutdown(bot: Bot):
+    RUNTIME.ready = False
+    RUNTIME.draining = True
+    if PROFILE is not None:
+        PROFILE.done.set()
+    settings = get_settings()
+    await drain(bot, settings.shutdown_timeout)
+    # остановленная сессия профилирования дописывает .collapsed и сводку, пока сессия Bot API открыта
+    if RUNTIME.profile_task is not None and not RUNTIME.profile_task.done():
+        try:
+            await asyncio.wait_for(RUNTIME.profile_task, 10)
+        except asyncio.TimeoutError:
+            logger.warning("Профиль не успели записать до остановки")
+        except Exception:
+            logger.exception("Не удалось завершить профилирование")
+    # накопленные дополнения не ждут таймера
+    if FOLLOWUPS:
+        try:
+            await asyncio.wait_for(flush_all_followups(bot), 10)
+        except asyncio.TimeoutError:
+            logger.warning("Не все дополнения к обращениям успели уйти в группу")
+    if settings.state_file:
+        try:
+            await save_state()
+        except Exception:
+            logger.exception("Не удалось сохранить %s", settings.state_file)
+
+    if RECORDER is not None:
+        await asyncio.to_thread(RECORDER.close)
+
+    for task in RUNTIME.background:
+        task.cancel()
+    await asyncio.gather(*RUNTIME.background, return_exceptions=True)
+    RUNTIME.background = []
+    if RUNTIME.health_runner is not None:
+        await RUNTIME.health_runner.cleanup()
+        RUNTIME.health_runner = None
 
 # -------------------- MAIN --------------------
-async def main():
-    bot = Bot(token=BOT_TOKEN)
+def build_dispatcher() -> Dispatcher:
+    global RECORDER
     dp = Dispatcher(storage=MemoryStorage())
+    RUNTIME.storage = dp.storage
+    settings = get_settings()
+    if settings.record_dir and RECORDER is None:
+        RECORDER = UpdateRecorder(
+            settings.record_dir, settings.record_salt or f"record:{settings.bot_token}",
+            settings.record_rotate_mb, settings.record_keep_files,
+        )
+    if RECORDER is not None:
+        dp.update.outer_middleware(RECORDER)
+    dp.update.outer_middleware(track_updates)
+    dp.message.middleware(profile_handlers)
+    dp.callback_query.middleware(profile_handlers)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
     dp.include_router(router)
+    return dp
+
+# Точка входа для main(), replay.py, bench_startup.py и тестов: окружение проверяется здесь,
+# session — своя сессия Bot API (например, заглушка без сети)
+def create_app(session: Optional[BaseSession] = None) -> Tuple[Bot, Dispatcher]:
+    settings = get_settings()
+    if not settings.bot_token:
+        raise RuntimeError("Не задан BOT_TOKEN в переменных окружения.")
+    if settings.support_chat_id is None:
+        raise RuntimeError("Не задан SUPPORT_CHAT_ID (ID группы) в переменных окружения.")
+    bot = Bot(token=settings.bot_token, session=session)
+    return bot, build_dispatcher()
+
+async def main():
+    bot, dp = create_app()
+    # SIGTERM/SIGINT останавливают polling, затем on_shutdown дожидается обработчиков
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
@@ -0,0 +1,386 @@
+"""Прогон записанного трафика (RECORD_DIR) через router бота без Telegram.
+
+    python replay.py recordings/updates-*.jsonl.gz               # в исходном темпе
+    python replay.py recordings/*.jsonl.gz --speed 20            # в 20 раз быстрее
+    python replay.py recordings/*.jsonl.gz --speed 0 --json r.json  # без пауз, отчёт в JSON
+    python replay.py --check-anonymization                       # в записи не остаётся реальных ID и имён
+
+Вместо Bot API используется заглушка: запросы не уходят в сеть, а считаются по методам.
+Отчёт: задержка обработки по типам апдейтов и число вызовов API — для сравнения релизов.
+Состояние бота в памяти, поэтому запись лучше начинать со старта процесса: иначе кнопки
+по тикетам, созданным до записи, при прогоне ответят «Тикет не найден».
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import itertools
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def read_records(paths: List[str]) -> Tuple[Dict[str, Any], List[Tuple[float, Dict[str, Any]]]]:
+    header: Dict[str, Any] = {}
+    records: List[Tuple[float, Dict[str, Any]]] = []
+    offset = 0.0        # сдвиг текущей сессии записи
+    session = None
+    session_end = 0.0   # последний t текущей сессии
+    for path in sorted(paths):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                row = json.loads(line)
+                if i == 0:
+                    header = header or row
+                    # файлы одной сессии (ротация) считают t от общего начала — сдвиг не нужен;
+                    # новая сессия (перезапуск бота) начинается с нуля и идёт после предыдущей.
+                    # В формате 1 сессии в заголовке нет: каждый файл — отдельная сессия.
+                    file_session = row.get("session") or path
+                    if file_session != session:
+                        offset += session_end
+                        session, session_end = file_session, 0.0
+                    continue
+                session_end = row["t"]
+                records.append((offset + row["t"], row["u"]))
+    return header, records
+
+
+def prepare_env(header: Dict[str, Any]):
+    # обязательные настройки bot.py читает в create_app()
+    os.environ.setdefault("BOT_TOKEN", "1:REPLAY")
+    if "SUPPORT_CHAT_ID" not in os.environ and header.get("support_chat_id") is not None:
+        os.environ["SUPPORT_CHAT_ID"] = str(header["support_chat_id"])
+    # ID групп поддержки в записи не хэшированы: маршруты те же, что были при записи.
+    # Для записей формата 1 (маршрутов в заголовке нет) SUPPORT_ROUTES задаётся вручную.
+    if "SUPPORT_ROUTES" not in os.environ and header.get("support_routes"):
+        os.environ["SUPPORT_ROUTES"] = header["support_routes"]
+    os.environ.pop("RECORD_DIR", None)
+    os.environ.pop("HEALTH_PORT", None)
+
+
+def make_stub_session(api_latency: float):
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Chat, ChatMemberOwner, Message, User
+
+    class StubSession(BaseSession):
+        def __init__(self):
+            super().__init__()
+            self.calls: Counter = Counter()
+            self.message_ids = itertools.count(1)
+
+        async def make_request(self, bot, method, timeout=None):
+            self.calls[type(method).__name__] += 1
+            if api_latency:
+                await asyncio.sleep(api_latency)
+            returning = method.__returning__
+            if returning is Message:
+                chat_id = int(getattr(method, "chat_id", 0) or 0)
+                return Message(
+                    message_id=next(self.message_ids),
+                    date=datetime.now(),
+                    chat=Chat(id=chat_id, type="private" if chat_id > 0 else "supergroup"),
+                )
+            if type(method).__name__ == "GetChatMember":
+                return ChatMemberOwner(user=User(id=method.user_id, is_bot=False, first_name="admin"), is_anonymous=False)
+            if returning is User:
+                return User(id=1, is_bot=True, first_name="replay")
+            if getattr(returning, "__origin__", None) is list:
+                return []
+            # bool и Union[Message, bool] (правки сообщений)
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            raise NotImplementedError("replay не скачивает файлы")
+
+        async def close(self):
+            pass
+
+    return StubSession()
+
+
+def event_key(update: Dict[str, Any]) -> str:
+    if "callback_query" in update:
+        cb = update["callback_query"].get("cb")
+        return f"callback {cb[0]}" if cb else "callback <stale>"
+    for kind in ("message", "edited_message"):
+        if kind in update:
+            msg = update[kind]
+            where = "group" if msg.get("chat", {}).get("id", 0) < 0 else "private"
+            content = next((k for k in ("text", "photo", "video", "document", "voice", "video_note", "audio") if k in msg), "other")
+            if content == "text" and msg["text"].startswith("/"):
+                content = msg["text"].split()[0]
+            return f"{kind} {where} {content}"
+    return next((k for k in update if k != "update_id"), "unknown")
+
+
+def restore_callbacks(bot_module, update: Dict[str, Any]) -> Dict[str, Any]:
+    query = update.get("callback_query")
+    if query and "cb" in query:
+        name, arg = query.pop("cb")
+        query["data"] = bot_module.cb(name, arg)
+    return update
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def replay(paths: List[str], speed: float, api_latency: float) -> Dict[str, Any]:
+    header, records = read_records(paths)
+    prepare_env(header)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as bot_module
+    from aiogram.types import Update
+
+    session = make_stub_session(api_latency)
+    bot, dp = bot_module.create_app(session)
+
+    latencies: Dict[str, List[float]] = {}
+    errors: Counter = Counter()
+
+    async def feed(key: str, update: Update):
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            errors[f"{key}: {type(e).__name__}"] += 1
+        latencies.setdefault(key, []).append(time.perf_counter() - started)
+
+    tasks = []
+    started = time.monotonic()
+    for t, raw in records:
+        if speed > 0:
+            delay = t / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        key = event_key(raw)
+        update = Update.model_validate(restore_callbacks(bot_module, raw), context={"bot": bot})
+        if speed > 0:
+            # как при polling: апдейты обрабатываются конкурентно
+            tasks.append(asyncio.create_task(feed(key, update)))
+        else:
+            await feed(key, update)
+    await asyncio.gather(*tasks)
+    wall = time.monotonic() - started
+
+    return {
+        "files": sorted(paths),
+        "updates": len(records),
+        "speed": speed,
+        "wall_s": round(wall, 3),
+        "handlers": {
+            key: {
+                "count": len(v),
+                "avg_ms": round(sum(v) / len(v) * 1000, 3),
+                "p50_ms": round(percentile(v, 0.5) * 1000, 3),
+                "p95_ms": round(percentile(v, 0.95) * 1000, 3),
+                "max_ms": round(max(v) * 1000, 3),
+            }
+            for key, v in sorted(latencies.items())
+        },
+        "api_calls": dict(session.calls.most_common()),
+        "api_calls_total": sum(session.calls.values()),
+        "errors": dict(errors),
+    }
+
+
+# Вступление в группу и пересланные сообщения: ID пользователей лежат не только под from/chat.
+# Чеки и вложения: ФИО бывает в имени файла; геопозиция и место — точные координаты и адрес.
+SAMPLE_UPDATES: List[Dict[str, Any]] = [
+    {
+        "update_id": 1,
+        "message": {
+            "message_id": 11, "date": 1700000000,
+            "chat": {"id": -100200300, "type": "supergroup", "title": "Клиенты"},
+            "from": {"id": 123456789, "is_bot": False, "first_name": "Иван", "username": "ivan"},
+            "new_chat_members": [{"id": 123456789, "is_bot": False, "first_name": "Иван", "username": "ivan"}],
+        },
+    },
+    {
+        "update_id": 2,
+        "message": {
+            "message_id": 12, "date": 1700000001,
+            "chat": {"id": -100200300, "type": "supergroup", "title": "Клиенты"},
+            "from": {"id": 111222333, "is_bot": False, "first_name": "Анна"},
+            "left_chat_member": {"id": 444555666, "is_bot": False, "first_name": "Пётр", "last_name": "С."},
+        },
+    },
+    {
+        "update_id": 3,
+        "message": {
+            "message_id": 13, "date": 1700000002,
+            "chat": {"id": 222333444, "type": "private", "first_name": "Мария"},
+            "from": {"id": 222333444, "is_bot": False, "first_name": "Мария"},
+            "forward_origin": {
+                "type": "user", "date": 1699999000,
+                "sender_user": {"id": 987654321, "is_bot": False, "first_name": "Олег", "username": "oleg"},
+            },
+            "via_bot": {"id": 555666777, "is_bot": True, "first_name": "Helper", "username": "helper_bot"},
+            "text": "пересланное сообщение",
+        },
+    },
+    {
+        "update_id": 4,
+        "message": {
+            "message_id": 14, "date": 1700000003,
+            "chat": {"id": 222333444, "type": "private", "first_name": "Мария"},
+            "from": {"id": 222333444, "is_bot": False, "first_name": "Мария"},
+            "forward_origin": {"type": "hidden_user", "date": 1699999001, "sender_user_name": "Скрытый Отправитель"},
+            "contact": {"phone_number": "+79990001122", "first_name": "Олег", "user_id": 987654321},
+        },
+    },
+    {
+        "update_id": 5,
+        "message": {
+            "message_id": 15, "date": 1700000004,
+            "chat": {"id": 222333444, "type": "private", "first_name": "Мария"},
+            "from": {"id": 222333444, "is_bot": False, "first_name": "Мария"},
+            "document": {"file_id": "DOC", "file_unique_id": "doc", "file_name": "Чек_Иванов_Иван_Иванович.pdf"},
+            "caption": "чек за 6 месяцев",
+        },
+    },
+    {
+        "update_id": 6,
+        "message": {
+            "message_id": 16, "date": 1700000005,
+            "chat": {"id": 222333444, "type": "private", "first_name": "Мария"},
+            "from": {"id": 222333444, "is_bot": False, "first_name": "Мария"},
+            "audio": {"file_id": "AUD", "file_unique_id": "aud", "duration": 5, "file_name": "Звонок Петрову.mp3"},
+        },
+    },
+    {
+        "update_id": 7,
+        "message": {
+            "message_id": 17, "date": 1700000006,
+            "chat": {"id": 222333444, "type": "private", "first_name": "Мария"},
+            "from": {"id": 222333444, "is_bot": False, "first_name": "Мария"},
+            "video": {"file_id": "VID", "file_unique_id": "vid", "width": 1, "height": 1, "duration": 3,
+                      "file_name": "ошибка у Марии Смирновой.mp4"},
+        },
+    },
+    {
+        "update_id": 8,
+        "message": {
+            "message_id": 18, "date": 1700000007,
+            "chat": {"id": 222333444, "type": "private", "first_name": "Мария"},
+            "from": {"id": 222333444, "is_bot": False, "first_name": "Мария"},
+            "location": {"latitude": 55.755814, "longitude": 37.617635, "horizontal_accuracy": 12.5},
+        },
+    },
+    {
+        "update_id": 9,
+        "message": {
+            "message_id": 19, "date": 1700000008,
+            "chat": {"id": 222333444, "type": "private", "first_name": "Мария"},
+            "from": {"id": 222333444, "is_bot": False, "first_name": "Мария"},
+            "venue": {
+                "location": {"latitude": 59.939095, "longitude": 30.315868},
+                "title": "Дом", "address": "ул. Ленина, 1, кв. 5", "foursquare_id": "4b0587f3f964a520",
+            },
+        },
+    },
+]
+
+PEER_ID_KEYS = ("id", "user_id", "chat_id")
+PEER_NAME_KEYS = (
+    "first_name", "last_name", "username", "title", "sender_user_name", "phone_number",
+    "file_name", "address", "foursquare_id", "latitude", "longitude", "horizontal_accuracy",
+)
+
+
+def collect(obj: Any, keys: Tuple[str, ...], found: set):
+    if isinstance(obj, list):
+        for v in obj:
+            collect(v, keys, found)
+    elif isinstance(obj, dict):
+        for k, v in obj.items():
+            if k in keys and not isinstance(v, (dict, list)):
+                found.add(v)
+            collect(v, keys, found)
+
+
+def leaf_values(obj: Any, found: set):
+    if isinstance(obj, list):
+        for v in obj:
+            leaf_values(v, found)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            leaf_values(v, found)
+    else:
+        found.add(obj)
+
+
+def check_anonymization() -> List[str]:
+    prepare_env({"support_chat_id": -100})
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot as bot_module
+    from aiogram.types import Update
+
+    problems: List[str] = []
+    support_chats = bot_module.get_settings().support_chats
+    with tempfile.TemporaryDirectory() as tmp:
+        recorder = bot_module.UpdateRecorder(tmp, "check")
+        try:
+            for raw in SAMPLE_UPDATES:
+                anon = recorder.anonymize_update(Update.model_validate(raw))
+                secrets: set = set()
+                collect(raw, PEER_ID_KEYS, secrets)
+                collect(raw, PEER_NAME_KEYS, secrets)
+                secrets -= support_chats
+                written: set = set()
+                leaf_values(anon, written)
+                leaked = secrets & written
+                if leaked:
+                    problems.append(f"update {raw['update_id']}: {sorted(map(str, leaked))}")
+        finally:
+            recorder.close()
+    return problems
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"Апдейтов: {report['updates']}, время: {report['wall_s']} с, скорость: x{report['speed'] or '∞'}")
+    print(f"\n{'тип апдейта':<44}{'шт':>7}{'ср.':>10}{'p50':>10}{'p95':>10}{'макс.':>10}  (мс)")
+    for key, h in report["handlers"].items():
+        print(f"{key:<44}{h['count']:>7}{h['avg_ms']:>10}{h['p50_ms']:>10}{h['p95_ms']:>10}{h['max_ms']:>10}")
+    print(f"\nВызовы Bot API: {report['api_calls_total']}")
+    for method, n in report["api_calls"].items():
+        print(f"  {method:<40}{n:>7}")
+    if report["errors"]:
+        print("\nОшибки:")
+        for key, n in report["errors"].items():
+            print(f"  {key}: {n}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Прогон записанных апдейтов через router бота.")
+    parser.add_argument("files", nargs="*", help="файлы updates-*.jsonl.gz из RECORD_DIR")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение времени; 0 — без пауз, по одному")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка заглушки Bot API, мс")
+    parser.add_argument("--json", help="сохранить отчёт в JSON (для сравнения релизов)")
+    parser.add_argument("--check-anonymization", action="store_true",
+                        help="прогнать примеры апдейтов через анонимизацию записи и проверить, что ID и имена не остались")
+    args = parser.parse_args(argv)
+
+    if args.check_anonymization:
+        problems = check_anonymization()
+        for p in problems:
+            print(f"Не анонимизировано: {p}")
+        print("Анонимизация: OK" if not problems else f"Анонимизация: ошибок {len(problems)}")
+        sys.exit(1 if problems else 0)
+    if not args.files:
+        parser.error("укажите файлы записи или --check-anonymization")
+
+    report = asyncio.run(replay(args.files, args.speed, args.api_latency / 1000))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()